@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+marker = '-- warm-up --'
+
+# folder and module of each service, and the warm-up done before the first job
+services = {
+   'sorter':   ('nmproc-srv/scripts', 'dicom_sorter', None),
+   'deepmrac': ('deepmrac/files/app', 'run', 'run.warmup()'),
+   'xnuccalc': ('xnuccalc2/app', 'run', 'run.warmup()'),
+}
+
+def parse_importtime(stderr):
+   # (self us, cumulative us, module, depth) for each line of -X importtime,
+   # up to the warm-up marker
+   imports = []
+   for line in stderr.splitlines():
+      if line == marker:
+         break
+      if not line.startswith('import time:') or 'imported package' in line:
+         continue
+      self_us, cumulative, name = line[len('import time:'):].split('|')
+      depth = (len(name) - len(name.lstrip()) - 1)//2
+      imports.append((int(self_us), int(cumulative), name.strip(), depth))
+   return imports
+
+def direct_imports(imports, module):
+   # the modules first imported by module, children are listed before
+   # their parent
+   children = []
+   for entry in imports:
+      if entry[3] == 0:
+         if entry[2] == module:
+            return children
+         children = []
+      elif entry[3] == 1:
+         children.append(entry)
+   return []
+
+def profile(name, warmup=False, python=sys.executable):
+   folder, module, warm = services[name]
+   code = f"import {module}"
+   if warmup and warm:
+      code += f"; import sys, time; sys.stderr.write({marker!r}+'\\n'); t0 = time.perf_counter(); {warm}; print('warmup', time.perf_counter()-t0)"
+   t0 = time.perf_counter()
+   proc = subprocess.run([python, '-X', 'importtime', '-c', code], cwd=os.path.join(root, folder), capture_output=True, text=True)
+   wall = time.perf_counter() - t0
+   if proc.returncode != 0:
+      raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+   warm_time = None
+   for line in proc.stdout.splitlines():
+      if line.startswith('warmup '):
+         warm_time = float(line.split()[1])
+   return wall, warm_time, parse_importtime(proc.stderr)
+
+def main():
+   parser = argparse.ArgumentParser(description='Profile cold start import time of each service')
+   parser.add_argument('service', nargs='*', help=f"services to profile, default all of {', '.join(services)}")
+   parser.add_argument('--top', type=int, default=10, help='number of slowest top level imports to list')
+   parser.add_argument('--warmup', action='store_true', help='also time the warm-up step')
+   parser.add_argument('--python', default=sys.executable, help='interpreter to profile with')
+   args = parser.parse_args()
+   for name in args.service:
+      if name not in services:
+         parser.error(f"unknown service {name}")
+
+   for name in args.service or services:
+      try:
+         wall, warm_time, imports = profile(name, args.warmup, args.python)
+      except RuntimeError as e:
+         print(f"{name:9} failed: {e}")
+         continue
+      total = sum(i[1] for i in imports if i[3] == 0)
+      line = f"{name:9} process {wall*1000:7.0f} ms  imports {total/1000:7.0f} ms  modules {len(imports)}"
+      if warm_time is not None:
+         line += f"  warm-up {warm_time*1000:7.0f} ms"
+      print(line)
+      # slowest modules imported by the service itself
+      top = sorted(direct_imports(imports, services[name][1]), key=lambda i: -i[1])
+      for self_us, cumulative, module, depth in top[:args.top]:
+         print(f"\t{cumulative/1000:8.1f} ms  {module}")
+
+if __name__ == '__main__':
+   main()
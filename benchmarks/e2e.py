@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import json
+import time
+import queue
+import types
+import tempfile
+import argparse
+import contextlib
+import importlib.util
+import numpy as np
+import pydicom
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path[:0] = [os.path.join(root, 'nmproc-srv', 'scripts'), os.path.join(root, 'xnuccalc2', 'app'), os.path.join(root, 'common')]
+from pynetdicom import AE, evt, AllStoragePresentationContexts
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from pydicom.filebase import DicomFileLike
+from pydicom.filewriter import write_file_meta_info
+from dicom_sorter import load_rulesets, collect_tags, sort_folder
+from dicom_sender import DicomSender
+from receiver import register_csa, CSA_NON_IMAGE_STORAGE
+
+local_aet = 'NMPROC'
+scanner_aet = 'SCANNER'
+pacs_aet = 'PACS'
+
+def load(name, path):
+   # both apps have a run.py, so load them under their own names
+   spec = importlib.util.spec_from_file_location(name, os.path.join(root, path))
+   module = importlib.util.module_from_spec(spec)
+   sys.modules[name] = module
+   spec.loader.exec_module(module)
+   return module
+
+def stub_model(delay):
+   # stand-in for the DeepMRAC model, same output shape as the input
+   def predict_DeepUTE(ute1, ute2, version):
+      time.sleep(delay)
+      return (ute1 + ute2)/2
+   sys.modules['DeepMRAC'] = types.SimpleNamespace(predict_DeepUTE=predict_DeepUTE)
+
+def storage_ae(aet):
+   ae = AE(aet)
+   ae.supported_contexts = AllStoragePresentationContexts
+   ae.add_supported_context(CSA_NON_IMAGE_STORAGE, [ExplicitVRLittleEndian, ImplicitVRLittleEndian])
+   return ae
+
+class Receiver:
+   # stand-in for storescp: one folder per association in scratch, handed
+   # over as a finished study when the association is released
+   def __init__(self, scratch):
+      self.scratch = scratch
+      self.folders = {}
+      self.studies = queue.Queue()
+      handlers = [(evt.EVT_C_STORE, self.store), (evt.EVT_RELEASED, self.released)]
+      self.server = storage_ae(local_aet).start_server(('127.0.0.1', 0), block=False, evt_handlers=handlers)
+      self.port = self.server.server_address[1]
+
+   def store(self, event):
+      folder = self.folders.get(id(event.assoc))
+      if folder is None:
+         folder = tempfile.mkdtemp(dir=self.scratch)
+         self.folders[id(event.assoc)] = folder
+      # write the received bytes as they are, behind the file meta
+      with open(os.path.join(folder, f"MR.{event.request.AffectedSOPInstanceUID}"), 'wb') as fp:
+         fp.write(b'\0'*128 + b'DICM')
+         write_file_meta_info(DicomFileLike(fp), event.file_meta, enforce_standard=True)
+         fp.write(event.request.DataSet.getvalue())
+      return 0x0000
+
+   def released(self, event):
+      folder = self.folders.pop(id(event.assoc), None)
+      if folder is not None:
+         self.studies.put((folder, event.assoc.requestor.ae_title, event.assoc.requestor.address))
+
+class Pacs:
+   # counts the results sent back by the apps
+   def __init__(self):
+      self.received = []
+      handlers = [(evt.EVT_C_STORE, self.store)]
+      self.server = storage_ae(pacs_aet).start_server(('127.0.0.1', 0), block=False, evt_handlers=handlers)
+      self.port = self.server.server_address[1]
+
+   def store(self, event):
+      self.received.append(time.perf_counter())
+      return 0x0000
+
+   def wait(self, n, timeout=60):
+      deadline = time.perf_counter() + timeout
+      while len(self.received) < n and time.perf_counter() < deadline:
+         time.sleep(0.01)
+      return self.received[n-1] if len(self.received) >= n else None
+
+def sorted_study(plan):
+   # folder the sorter moved studyinfo.json to
+   for ruleset in plan['rulesets']:
+      if ruleset['done']:
+         for action in ruleset['actions']:
+            if os.path.basename(action['dest']) == 'studyinfo.json':
+               return ruleset['name'], os.path.dirname(action['dest'])
+   return None, None
+
+def run_study(kind, files, apps, receiver, pacs, scanner, rulesets, tags, data_out, workers, quiet):
+   datasets = [pydicom.dcmread(f) for f in files]
+   nbytes = sum(os.path.getsize(f) for f in files)
+   expected = {'deepmrac': 192, 'xnuccalc': 2}[kind]
+   timings = {'files': len(files), 'MB': nbytes/2**20}
+   output = io.StringIO() if quiet else sys.stdout
+
+   # scanner to receiver, end of study on release
+   t0 = time.perf_counter()
+   with contextlib.redirect_stdout(output):
+      scanner.send(datasets, '127.0.0.1', receiver.port, local_aet)
+      scanner.close()
+   folder, remote_aet, remote_ip = receiver.studies.get(timeout=60)
+   t1 = time.perf_counter()
+   timings['store'] = t1 - t0
+
+   # sort.sh, without the daemon
+   with open(os.path.join(folder, 'studyinfo.json'), 'w') as fp:
+      json.dump({'Local_AET': local_aet, 'Remote_AET': remote_aet, 'Remote_Host': remote_ip}, fp, indent=3)
+   with contextlib.redirect_stdout(output):
+      plan = sort_folder(folder, data_out, rulesets, workers, tags=tags, progress=False)
+   t2 = time.perf_counter()
+   timings['sort'] = t2 - t1
+   timings['sort_scan'] = plan['timings']['scan']
+   ruleset, study = sorted_study(plan)
+   if study is None:
+      raise RuntimeError(f"{kind} study was not sorted")
+
+   # app job and send to pacs
+   n0 = len(pacs.received)
+   with contextlib.redirect_stdout(output):
+      if kind == 'deepmrac':
+         status = apps['deepmrac'].process_batch([study])[0]
+      else:
+         apps['xnuccalc'].send_results(study, apps['xnuccalc'].process_fids(study))
+         status = 'done'
+   t3 = time.perf_counter()
+   timings['app'] = t3 - t2
+   last = pacs.wait(n0 + expected)
+   if status != 'done' or last is None:
+      raise RuntimeError(f"{kind} study failed, {len(pacs.received)-n0}/{expected} results received")
+   timings['pacs'] = last - t2
+   timings['total'] = last - t0
+   return timings
+
+def main():
+   parser = argparse.ArgumentParser(description='Time the pipeline from C-STORE receive to results in PACS')
+   parser.add_argument('--ute', type=int, default=1, help='number of UTE/UMAP studies')
+   parser.add_argument('--fid', type=int, default=1, help='number of coil calibration FID studies')
+   parser.add_argument('--size', type=int, default=192, help='rows/columns of synthetic UTE slices')
+   parser.add_argument('-j', '--workers', type=int, default=4, help='sorter header readers')
+   parser.add_argument('--model-delay', type=float, default=0.0, help='seconds the stub model sleeps per study')
+   parser.add_argument('--model', action='store_true', help='use the real DeepMRAC model instead of the stub')
+   parser.add_argument('--json', metavar='FILE', help='write the timings of each study as json')
+   parser.add_argument('-v', '--verbose', action='store_true', help='show the output of the sorter and apps')
+   args = parser.parse_args()
+
+   sys.path.insert(0, os.path.join(root, 'nmproc-srv', 'benchmarks'))
+   from synthetic import make_study
+   make_fids = load('xnuccalc_synthetic', 'xnuccalc2/benchmarks/synthetic.py').make_fids
+   if not args.model:
+      stub_model(args.model_delay)
+
+   with tempfile.TemporaryDirectory() as tmp:
+      source, scratch, data_out = (os.path.join(tmp, d) for d in ('source', 'scratch', 'data'))
+      os.makedirs(scratch)
+      t0 = time.perf_counter()
+      studies = [('deepmrac', make_study(os.path.join(source, f"ute{i}"), size=args.size)) for i in range(args.ute)]
+      # alternate between the two layouts of the siemens CSA headers
+      studies += [('xnuccalc', make_fids(os.path.join(source, f"fid{i}"), seed=i, layout=('image', 'non-image')[i % 2])) for i in range(args.fid)]
+      print(f"Generated {len(studies)} studies in {time.perf_counter()-t0:.2f} s")
+
+      register_csa()
+      receiver, pacs = Receiver(scratch), Pacs()
+      scanner = DicomSender(scanner_aet)
+      rulesets = load_rulesets()
+      tags = collect_tags(rulesets)
+      apps = {
+         'deepmrac': load('deepmrac_run', 'deepmrac/files/app/run.py'),
+         'xnuccalc': load('xnuccalc_run', 'xnuccalc2/app/run.py'),
+      }
+      for app in apps.values():
+         app.ip_adr, app.remote_port, app.sender.retry_dir, app.sender.failed_dir = '127.0.0.1', pacs.port, None, None
+         t0 = time.perf_counter()
+         app.warmup()
+         print(f"{app.__name__} warm-up {time.perf_counter()-t0:.2f} s")
+
+      results = []
+      try:
+         for kind, files in studies:
+            results.append(dict(run_study(kind, files, apps, receiver, pacs, scanner, rulesets, tags, data_out, args.workers, not args.verbose), kind=kind))
+      finally:
+         receiver.server.shutdown()
+         pacs.server.shutdown()
+
+   print(f"{'study':9} {'files':>6} {'MB':>7} {'store':>7} {'files/s':>8} {'MB/s':>6} {'sort':>7} {'app':>7} {'pacs':>7} {'total':>7}")
+   for r in results:
+      print(f"{r['kind']:9} {r['files']:6d} {r['MB']:7.1f} {r['store']:7.2f} {r['files']/r['store']:8.0f} {r['MB']/r['store']:6.1f} {r['sort']:7.2f} {r['app']:7.2f} {r['pacs']:7.2f} {r['total']:7.2f}")
+   for kind in sorted({r['kind'] for r in results}):
+      total = [r['total'] for r in results if r['kind'] == kind]
+      print(f"{kind}: median latency {np.median(total):.2f} s over {len(total)} studies")
+   if args.json:
+      with open(args.json, 'w') as fp:
+         json.dump(results, fp, indent=3)
+
+if __name__ == '__main__':
+   main()
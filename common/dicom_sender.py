@@ -0,0 +1,224 @@
+import os
+import json
+import socket
+import time
+import threading
+import pydicom as dicom
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+# statuses where the remote has stored the instance
+stored_status = {0x0000, 0xB000, 0xB006, 0xB007}
+
+def transient(status):
+   # out of resources (0xA7xx) may succeed later, other failures will not
+   return status & 0xFF00 == 0xA700
+
+# keeps one association open per remote AE and stores failed sends on disk
+# until they can be delivered. instances the remote rejects are moved to
+# failed_dir instead of being retried. shared by the app containers, which
+# copy it from common/ at build time
+class DicomSender:
+   def __init__(self, local_aet, retry_dir=None, failed_dir=None, idle_timeout=30, retry_interval=60):
+      self.local_aet = local_aet
+      self.ae = None # created on first connect, pynetdicom is slow to import
+      self.retry_dir = retry_dir
+      self.failed_dir = failed_dir
+      self.idle_timeout = idle_timeout
+      self.retry_interval = retry_interval
+      self.assocs = {} # (host, port, aet) -> [association, contexts, last used]
+      self.locks = {}
+      self.last_retry = {}
+      self.last_scan = -retry_interval
+      self.lock = threading.Lock()
+      self.closer = threading.Thread(target=self._close_idle, daemon=True)
+      self.closer.start()
+
+   def _lock(self, key):
+      with self.lock:
+         return self.locks.setdefault(key, threading.Lock())
+
+   def _contexts(self, datasets):
+      # all abstract/transfer syntax pairs needed, uncompressed data may
+      # also be sent in one of the little endian syntaxes
+      contexts = set()
+      for ds in datasets:
+         ts = ds.file_meta.TransferSyntaxUID
+         contexts.add((ds.SOPClassUID, ts))
+         if not ts.is_compressed:
+            contexts.add((ds.SOPClassUID, ExplicitVRLittleEndian))
+            contexts.add((ds.SOPClassUID, ImplicitVRLittleEndian))
+      return contexts
+
+   def _associate(self, key, contexts):
+      host, port, aet = key
+      entry = self.assocs.pop(key, None)
+      if entry is not None:
+         # renegotiate with the old contexts too, so the next study of
+         # the same kind can reuse the association
+         contexts = contexts | entry[1]
+         self._release(entry[0])
+      syntaxes = {}
+      for sop_class, ts in sorted(contexts):
+         syntaxes.setdefault(sop_class, []).append(ts)
+      from pynetdicom import AE, build_context
+      if self.ae is None:
+         self.ae = AE(self.local_aet)
+      requested = [build_context(sop_class, ts) for sop_class, ts in syntaxes.items()]
+      assoc = self.ae.associate(host, port, contexts=requested[:128], ae_title=aet)
+      if not assoc.is_established:
+         print(f"Could not connect to {host}:{port} ({aet})")
+         return None
+      # C-STOREs are small writes followed by a wait for the response, so
+      # without this each one stalls on the remote's delayed ack
+      assoc.dul.socket.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.assocs[key] = [assoc, contexts, time.monotonic()]
+      return assoc
+
+   def _get(self, key, contexts):
+      entry = self.assocs.get(key)
+      if entry is not None and entry[0].is_established and contexts <= entry[1]:
+         entry[2] = time.monotonic()
+         return entry[0]
+      return self._associate(key, contexts)
+
+   def _release(self, assoc):
+      try:
+         if assoc.is_established:
+            assoc.release()
+      except Exception as e:
+         print(f"Release failed: {e}")
+
+   def _store(self, key, datasets):
+      # send each instance over the open association, reconnecting once if
+      # the remote has dropped it. returns the datasets to retry later and
+      # the datasets the remote rejected
+      contexts = self._contexts(datasets)
+      queued, rejected = [], []
+      for i, ds in enumerate(datasets):
+         status = None
+         for _ in range(2):
+            assoc = self._get(key, contexts)
+            if assoc is None:
+               # no connection, keep the rest for later
+               return queued + datasets[i:], rejected
+            status = assoc.send_c_store(ds)
+            if status:
+               break
+            # timed out, aborted or invalid response
+            self.assocs.pop(key, None)
+            self._release(assoc)
+         if not status:
+            print(f"Sending {ds.SOPInstanceUID} timed out, was aborted or received invalid response")
+            queued.append(ds)
+         elif status.Status not in stored_status:
+            print(f"Sending {ds.SOPInstanceUID} failed, error 0x{status.Status:04X}")
+            (queued if transient(status.Status) else rejected).append(ds)
+      if key in self.assocs:
+         self.assocs[key][2] = time.monotonic()
+      return queued, rejected
+
+   def send(self, datasets, remote_host, remote_port, remote_aet):
+      if isinstance(datasets, dicom.Dataset):
+         datasets = [datasets]
+      key = (remote_host, int(remote_port), remote_aet)
+      with self._lock(key):
+         self._retry(key)
+         queued, rejected = self._store(key, list(datasets))
+         sent = len(datasets) - len(queued) - len(rejected)
+         if sent:
+            print(f"Sent {sent} files succesfully to {remote_host}:{remote_port} ({remote_aet})")
+         if queued:
+            self._queue(key, queued)
+         if rejected:
+            self._reject(key, rejected)
+      return not queued and not rejected
+
+   def _queue_dir(self, key, root=None):
+      host, port, aet = key
+      return os.path.join(root or self.retry_dir, f"{aet}@{host}_{port}")
+
+   def _queue(self, key, datasets):
+      if not self.retry_dir:
+         print(f"Dropped {len(datasets)} files for {key[2]}")
+         return
+      path = self._queue_dir(key)
+      os.makedirs(path, exist_ok=True)
+      with open(os.path.join(path, 'destination.json'), 'w') as fp:
+         json.dump({'host': key[0], 'port': key[1], 'aet': key[2]}, fp)
+      for ds in datasets:
+         ds.save_as(os.path.join(path, f"{ds.SOPInstanceUID}.dcm"), write_like_original=False)
+      print(f"Queued {len(datasets)} files for retry in {path}")
+
+   def _reject(self, key, datasets):
+      # retrying will not help, keep them aside for inspection
+      if not self.failed_dir:
+         print(f"Dropped {len(datasets)} rejected files for {key[2]}")
+         return
+      path = self._queue_dir(key, self.failed_dir)
+      os.makedirs(path, exist_ok=True)
+      for ds in datasets:
+         ds.save_as(os.path.join(path, f"{ds.SOPInstanceUID}.dcm"), write_like_original=False)
+      print(f"Moved {len(datasets)} rejected files to {path}")
+
+   def _retry(self, key, force=False):
+      if not self.retry_dir:
+         return
+      path = self._queue_dir(key)
+      if not os.path.isdir(path):
+         return
+      now = time.monotonic()
+      if not force and now - self.last_retry.get(key, -self.retry_interval) < self.retry_interval:
+         return
+      self.last_retry[key] = now
+      files = sorted(f for f in os.listdir(path) if f.endswith('.dcm'))
+      datasets = [dicom.dcmread(os.path.join(path, f)) for f in files]
+      if not datasets:
+         return
+      queued, rejected = self._store(key, datasets)
+      if rejected:
+         self._reject(key, rejected)
+      failed = {ds.SOPInstanceUID for ds in queued}
+      for f, ds in zip(files, datasets):
+         if ds.SOPInstanceUID not in failed:
+            os.remove(os.path.join(path, f))
+      print(f"Retried {len(datasets)} queued files for {key[2]}, {len(failed)} still queued, {len(rejected)} rejected")
+      if not failed:
+         os.remove(os.path.join(path, 'destination.json'))
+         os.rmdir(path)
+
+   def retry(self, force=False):
+      # try to deliver everything in the retry queue, at most once per
+      # retry_interval unless forced. called at startup and periodically
+      # from the watcher loop
+      now = time.monotonic()
+      if not force and now - self.last_scan < self.retry_interval:
+         return
+      self.last_scan = now
+      if not self.retry_dir or not os.path.isdir(self.retry_dir):
+         return
+      for d in os.listdir(self.retry_dir):
+         try:
+            with open(os.path.join(self.retry_dir, d, 'destination.json')) as fp:
+               dest = json.load(fp)
+         except (OSError, ValueError):
+            continue
+         key = (dest['host'], int(dest['port']), dest['aet'])
+         with self._lock(key):
+            self._retry(key, force)
+
+   def _close_idle(self):
+      while True:
+         time.sleep(min(5, self.idle_timeout))
+         for key in list(self.assocs):
+            with self._lock(key):
+               entry = self.assocs.get(key)
+               if entry is not None and time.monotonic() - entry[2] > self.idle_timeout:
+                  del self.assocs[key]
+                  self._release(entry[0])
+
+   def close(self):
+      for key in list(self.assocs):
+         with self._lock(key):
+            entry = self.assocs.pop(key, None)
+            if entry is not None:
+               self._release(entry[0])
@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import hashlib
+import queue
+import threading
+import traceback
+import multiprocessing
+from datetime import datetime
+
+state_file = ".jobstate.json" # written in each study folder
+index_file = "series_index.json" # written next to each series by the sorter
+finished = {'done', 'failed', 'timeout'}
+processed_limit = 10000 # fingerprints of processed studies kept
+hang_grace = 60 # seconds a timed out in-process job gets to return before the process exits
+
+def read_state(path):
+   try:
+      with open(os.path.join(path, state_file)) as fp:
+         return json.load(fp).get('state')
+   except (OSError, ValueError):
+      return None
+
+def write_state(path, state, **info):
+   tmp = os.path.join(path, f"{state_file}.tmp")
+   try:
+      with open(tmp, 'w') as fp:
+         json.dump(dict(info, state=state, time=datetime.now().isoformat()), fp)
+      os.replace(tmp, os.path.join(path, state_file))
+   except OSError as e:
+      print(f"Could not write job state in {path}: {e}")
+
+def study_fingerprint(path):
+   # hash of the instances listed in the series indexes of a study, with
+   # their content digests if the sorter made them. None without indexes
+   items = []
+   for dirpath, dirs, files in os.walk(path):
+      if index_file not in files:
+         continue
+      try:
+         with open(os.path.join(dirpath, index_file)) as fp:
+            entries = json.load(fp)['files']
+      except (OSError, ValueError, KeyError):
+         return None
+      items += [f"{e.get('SOPInstanceUID')} {e.get('digest') or ''}" for e in entries]
+   if not items:
+      return None
+   return hashlib.sha1('\n'.join(sorted(items)).encode()).hexdigest()
+
+def scan_studies(root, json_file, since=0):
+   # study folders directly below root, oldest first. returns the folders
+   # with json_file that have not finished and the folders still waiting
+   # for it. folders without a job state from before since were there
+   # before jobs had states, and are left alone
+   ready, waiting = [], []
+   try:
+      with os.scandir(root) as it:
+         dirs = [e.path for e in it if e.is_dir() and not e.name.startswith('.')]
+   except OSError as e:
+      print(f"Could not scan {root}: {e}")
+      return ready, waiting
+   for path in dirs:
+      try:
+         ready.append((os.stat(os.path.join(path, json_file)).st_mtime, path))
+      except OSError:
+         try:
+            if os.stat(path).st_mtime >= since:
+               waiting.append(path)
+         except OSError:
+            pass
+   states = [(mtime, path, read_state(path)) for mtime, path in sorted(ready)]
+   ready = [path for mtime, path, state in states if state not in finished and (state is not None or mtime >= since)]
+   return ready, waiting
+
+# runs study jobs in a bounded pool of worker threads, so the watcher keeps
+# handling events while a job runs. jobs are de-duplicated by path, and the
+# paths that have not finished are kept in queue_file so a restart does not
+# drop them. the state of each job is written to state_file in its folder.
+# with a processed_file, studies whose inputs have already been processed
+# (e.g. re-sent by the scanner) are skipped. shared by the app containers,
+# which copy it from common/ at build time
+class JobScheduler:
+   def __init__(self, func, callback=None, workers=1, timeout=None, queue_file=None, isolate=True, batch_size=1, processed_file=None, first_run_file=None):
+      # func(path) is run for each job, in a forked process if isolate is set
+      # so it can be killed on timeout, otherwise a job past the timeout is
+      # given up by the watchdog. callback(path, result) is run in this
+      # process with the result of func. with batch_size > 1, func and
+      # callback get a list of up to batch_size paths instead, the first
+      # and those already queued behind it, and func returns a status for
+      # each path
+      self.func = func
+      self.callback = callback
+      self.timeout = timeout
+      self.queue_file = queue_file
+      self.isolate = isolate
+      self.batch_size = max(1, batch_size)
+      self.mp = multiprocessing.get_context('fork')
+      self.pending = [] # queued or running, in submit order
+      self.submitted = {} # path -> time of submit
+      self.processed_file = processed_file
+      self.first_run_file = first_run_file
+      self.processed = self._load(processed_file) or {} # fingerprint -> path
+      self.fingerprints = {} # path -> fingerprint of its inputs
+      self.running = {} # worker thread -> (paths, start time)
+      self.hung = {} # worker thread -> time its job timed out
+      self.lock = threading.Lock()
+      self.queue = queue.Queue()
+      self.workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, workers))]
+      for t in self.workers:
+         t.start()
+      if not isolate and timeout:
+         threading.Thread(target=self._watchdog, daemon=True).start()
+
+   def restore(self):
+      # resubmit the jobs left over from the last run
+      paths = self._load(self.queue_file)
+      if paths is None:
+         return 0
+      n = sum(self.submit(p) for p in paths if os.path.isdir(p))
+      print(f"Restored {n} jobs from {self.queue_file}")
+      return n
+
+   def recover(self, root, json_file, watch=None):
+      # queue the studies below root that arrived or were left unfinished
+      # while the watcher was down. watch(path) is called for folders still
+      # waiting for json_file, after which they are checked once more in
+      # case the file arrived in between
+      t0 = time.perf_counter()
+      ready, waiting = scan_studies(root, json_file, self.first_run())
+      for path in waiting:
+         if watch is not None:
+            watch(path)
+         if os.path.isfile(os.path.join(path, json_file)):
+            ready.append(path)
+      n = sum(self.submit(path) for path in ready if os.path.normpath(path) not in self.pending)
+      print(f"Recovered {n} studies from {root} in {time.perf_counter()-t0:.2f} s, watching {len(waiting)} unfinished folders")
+      return n
+
+   def first_run(self):
+      # time of the first start with a first_run_file. studies from before
+      # it have no job state, as they were processed by the old watcher,
+      # and are not recovered
+      data = self._load(self.first_run_file)
+      if data is None:
+         data = {'time': time.time()}
+         self._dump(self.first_run_file, data)
+      return data['time'] if self.first_run_file else 0
+
+   def previous_run(self, path, fingerprint=None):
+      # an earlier study with the same inputs as path, processed or still
+      # pending, None if the inputs have changed or are not known
+      fingerprint = fingerprint or study_fingerprint(path)
+      with self.lock:
+         return self._previous(fingerprint)
+
+   def _previous(self, fingerprint):
+      # called with the lock held
+      if fingerprint is None:
+         return None
+      return self.processed.get(fingerprint) or next((p for p, f in self.fingerprints.items() if f == fingerprint), None)
+
+   def submit(self, path):
+      path = os.path.normpath(path)
+      fingerprint = study_fingerprint(path) if self.processed_file else None
+      with self.lock:
+         if path in self.pending:
+            print(f"{path} is already queued")
+            return False
+         # checked together with queueing, so a copy re-sent while the
+         # first one is queued or running is not run twice
+         previous = self._previous(fingerprint)
+         if previous is None:
+            self.pending.append(path)
+            self.submitted[path] = time.monotonic()
+            self.fingerprints[path] = fingerprint
+            self._save()
+            n = len(self.pending)
+      if previous is not None:
+         print(f"Inputs of {path} have not changed since {previous}, skipping")
+         write_state(path, 'done', previous=previous)
+         return False
+      write_state(path, 'queued')
+      self.queue.put(path)
+      print(f"Queued {path} ({n} pending)")
+      return True
+
+   def join(self):
+      # wait until all submitted jobs are done
+      self.queue.join()
+
+   def _load(self, filename):
+      if not filename or not os.path.isfile(filename):
+         return None
+      try:
+         with open(filename) as fp:
+            return json.load(fp)
+      except (OSError, ValueError) as e:
+         print(f"Could not read {filename}: {e}")
+         return None
+
+   def _dump(self, filename, data):
+      if not filename:
+         return
+      tmp = f"{filename}.tmp"
+      try:
+         with open(tmp, 'w') as fp:
+            json.dump(data, fp)
+         os.replace(tmp, filename)
+      except OSError as e:
+         print(f"Could not write {filename}: {e}")
+
+   def _save(self):
+      self._dump(self.queue_file, self.pending)
+
+   def _next(self):
+      # the next job, with the jobs already queued behind it. a lone job is
+      # started right away instead of waiting for others to arrive
+      paths = [self.queue.get()]
+      while len(paths) < self.batch_size:
+         try:
+            paths.append(self.queue.get_nowait())
+         except queue.Empty:
+            break
+      return paths
+
+   def _worker(self):
+      me = threading.current_thread()
+      while True:
+         paths = self._next()
+         # batched jobs get the list of paths
+         job = paths if self.batch_size > 1 else paths[0]
+         for path in paths:
+            write_state(path, 'processing')
+         with self.lock:
+            self.running[me] = (paths, time.monotonic())
+         t0 = time.perf_counter()
+         try:
+            status, result = self._fork(job) if self.isolate else self._call(job)
+            if status == 'done' and self.callback is not None:
+               self.callback(job, result)
+         except Exception:
+            traceback.print_exc()
+            status = 'failed'
+         elapsed = time.perf_counter() - t0
+         statuses = [status]*len(paths)
+         if self.batch_size > 1 and status == 'done':
+            statuses = list(result)
+         with self.lock:
+            if self.running.pop(me, None) is None:
+               # already marked as timed out by the watchdog
+               self.hung.pop(me, None)
+               print(f"{job} finished {status} after {elapsed:.1f} s, past the timeout")
+               continue
+            if self.batch_size > 1:
+               print(f"Batch of {len(paths)} jobs {status} in {elapsed:.1f} s")
+            self._finish(paths, statuses)
+         for path in paths:
+            self.queue.task_done()
+
+   def _finish(self, paths, statuses):
+      # called with the lock held
+      now = time.monotonic()
+      for path, path_status in zip(paths, statuses):
+         # latency from submit, including the time spent waiting
+         latency = now - self.submitted.pop(path)
+         print(f"Job {path} {path_status} in {latency:.1f} s")
+         write_state(path, path_status, latency=round(latency, 3))
+         self.pending.remove(path)
+         fingerprint = self.fingerprints.pop(path, None)
+         if path_status == 'done' and fingerprint is not None:
+            self.processed.pop(fingerprint, None)
+            self.processed[fingerprint] = path
+      self._save()
+      if self.processed_file:
+         # oldest first, so the first ones are dropped
+         self.processed = dict(list(self.processed.items())[-processed_limit:])
+         self._dump(self.processed_file, self.processed)
+
+   def _watchdog(self):
+      # jobs run in threads can not be killed, and a second worker would run
+      # the model next to the hung one. a job past the timeout is marked as
+      # timed out and taken off the queue. its worker picks up the next job
+      # if it returns within hang_grace, otherwise the process exits so the
+      # container is restarted and the queue restored without the job
+      while True:
+         time.sleep(min(5, self.timeout))
+         now = time.monotonic()
+         with self.lock:
+            hung = [(t, paths) for t, (paths, start) in self.running.items() if now - start > self.timeout]
+            for t, paths in hung:
+               del self.running[t]
+               self.hung[t] = now
+               print(f"{', '.join(paths)} ran past the timeout of {self.timeout} s")
+               self._finish(paths, ['timeout']*len(paths))
+            stuck = [t for t, since in self.hung.items() if now - since > hang_grace]
+         for t, paths in hung:
+            for path in paths:
+               self.queue.task_done()
+         if stuck:
+            print(f"Timed out job did not return within {hang_grace} s, exiting")
+            os._exit(1)
+
+   def _call(self, job):
+      try:
+         return 'done', self.func(job)
+      except Exception:
+         traceback.print_exc()
+         return 'failed', None
+
+   def _child(self, conn, job):
+      conn.send(self._call(job))
+      conn.close()
+
+   def _fork(self, job):
+      recv, send = self.mp.Pipe(duplex=False)
+      p = self.mp.Process(target=self._child, args=(send, job), daemon=True)
+      p.start()
+      send.close()
+      try:
+         if not recv.poll(self.timeout):
+            p.terminate()
+            return 'timeout', None
+         return recv.recv()
+      except EOFError:
+         # child died without a result
+         return 'failed', None
+      finally:
+         recv.close()
+         p.join()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import types
+import tempfile
+import argparse
+import importlib
+import tracemalloc
+import numpy as np
+import pydicom as dicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'files', 'app'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'common'))
+try:
+   importlib.import_module('DeepMRAC')
+except ImportError:
+   # the model is not needed to time output synthesis
+   sys.modules['DeepMRAC'] = types.SimpleNamespace(predict_DeepUTE=None)
+import run
+
+def make_umap(path, n, size):
+   os.makedirs(path)
+   series_uid = generate_uid()
+   for z in range(n):
+      meta = FileMetaDataset()
+      meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+      meta.MediaStorageSOPInstanceUID = generate_uid()
+      meta.TransferSyntaxUID = ExplicitVRLittleEndian
+      ds = Dataset()
+      ds.file_meta = meta
+      ds.is_little_endian = True
+      ds.is_implicit_VR = False
+      ds.SOPClassUID = meta.MediaStorageSOPClassUID
+      ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+      ds.SeriesInstanceUID = series_uid
+      ds.SeriesDescription = 'Head_MRAC_UTE_UMAP'
+      ds.InstanceNumber = z+1
+      ds.SamplesPerPixel = 1
+      ds.PhotometricInterpretation = 'MONOCHROME2'
+      ds.Rows = ds.Columns = size
+      ds.BitsAllocated = 16
+      ds.BitsStored = 12
+      ds.HighBit = 11
+      ds.PixelRepresentation = 0
+      ds.PixelData = np.zeros((size, size), dtype=np.uint16).tobytes()
+      ds.save_as(os.path.join(path, f"{z+1:05d}.dcm"), write_like_original=False)
+
+def nda2dcm_reference(DeepX, umap_orig):
+   # per slice full read, pixel decode and cast, as before
+   dcm = []
+   maxVal = int(DeepX.max())
+   newSIUID = dicom.uid.generate_uid(prefix='1.3.12.2.1107.5.2.38.51014.')
+   for f in os.listdir(umap_orig):
+      ds = dicom.read_file(os.path.join(umap_orig, f))
+      z = int(ds.InstanceNumber)-1
+      ds.SeriesInstanceUID = newSIUID
+      ds.SeriesDescription = "DeepUTE"
+      ds.SeriesNumber = "505"
+      ds.SOPInstanceUID = dicom.uid.generate_uid(prefix='1.3.12.2.1107.5.2.38.51014.')
+      ds.LargestImagePixelValue = maxVal
+      ds.PixelData = DeepX[z,:,:].astype(ds.pixel_array.dtype).tobytes()
+      dcm.append(ds)
+   return dcm
+
+def measure(fn, DeepX, path):
+   tracemalloc.start()
+   t0 = time.perf_counter()
+   dcm = fn(DeepX, path)
+   dt = time.perf_counter() - t0
+   peak = tracemalloc.get_traced_memory()[1]
+   tracemalloc.stop()
+   pixels = {int(ds.InstanceNumber): bytes(ds.PixelData) for ds in dcm}
+   return dt, peak, pixels
+
+def main():
+   parser = argparse.ArgumentParser(description='Time DeepUTE output series synthesis')
+   parser.add_argument('--size', type=int, default=192)
+   parser.add_argument('--repeat', type=int, default=3)
+   args = parser.parse_args()
+
+   DeepX = np.random.default_rng(0).uniform(0, 1500, (args.size,)*3)
+   with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'umap')
+      make_umap(path, args.size, args.size)
+      for name, fn in (('reference', nda2dcm_reference), ('nda2dcm', run.nda2dcm)):
+         runs = [measure(fn, DeepX, path) for _ in range(args.repeat)]
+         dt = min(r[0] for r in runs)
+         peak = min(r[1] for r in runs)
+         print(f"{name:10} {dt*1000:8.1f} ms  peak {peak/2**20:7.1f} MiB")
+         if name == 'reference':
+            reference = runs[0][2]
+         else:
+            print(f"identical pixel data: {runs[0][2] == reference}")
+
+if __name__ == '__main__':
+   main()
@@ -2,57 +2,64 @@
 import os
 import sys
 import json
+import time
+import traceback
 import numpy as np
 import pydicom as dicom
-from pynetdicom import AE
+from pydicom.pixel_data_handlers.util import pixel_dtype
+from dicom_sender import DicomSender
+from scheduler import JobScheduler
 from inotify.adapters import Inotify
 from inotify.constants import IN_CREATE, IN_ISDIR
-from DeepMRAC import predict_DeepUTE
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 monitor = ["/data/UTE"]
 json_file = "studyinfo.json"
+index_file = "series_index.json" # written next to each series by the sorter
 local_aet="NMPROC"
 ip_adr="10.85.77.52"
-
-def send_dicom(dcm, remote_host, remote_port, remote_aet, local_aet):
-   # setup application entry
-   ae = AE(local_aet)
-   ae.add_requested_context(dcm[0].SOPClassUID, dcm[0].file_meta.TransferSyntaxUID)
-   # Associated with peer
-   assoc = ae.associate(remote_host, remote_port, ae_title=remote_aet)
-
-   if assoc.is_established:
-      sent_files = 0
-      failed = False
-      for d in dcm:
-         status = assoc.send_c_store(d)
-         if not status:
-            print('Connection timed out, was aborted or received invalid response')
-            failed = True
-            break
-         elif status.Status != 0x0000:
-            print(f"Sending failed, error 0x{status.Status:04X}")
-            failed = True
-            break
-         sent_files += 1
-      # Check the status of the storage request
-      if not failed:
-         # If the storage request succeeded this will be 0x0000
-         print(f"Sent {sent_files} files succesfully to {remote_host}:{remote_port} ({remote_aet})")
-      assoc.release()
-
-   return not failed
+remote_port=104
+input_dtype = np.float32 # dtype of the volumes handed to the model
+load_workers = 8
+retry_dir = "/data/.retry" # results that could not be sent are queued here
+failed_dir = "/data/.failed" # results rejected by the remote are kept here
+queue_file = "/data/.deepmrac_jobs.json" # studies not yet processed
+processed_file = "/data/.deepmrac_processed.json" # inputs of processed studies
+first_run_file = "/data/.deepmrac_first_run.json" # studies from before it are not recovered
+job_timeout = 1800 # seconds, a hung job is marked timeout and the watcher restarted
+batch_size = 4 # queued studies taken at once, the model still runs once per study
+batch_loaders = 2 # studies loaded ahead of the model
+
+sender = DicomSender(local_aet, retry_dir=retry_dir, failed_dir=failed_dir)
+model = None # predict_DeepUTE, set by warmup
+
+def warmup():
+   # import the model and tensorflow ahead of the first study
+   global model
+   if model is None:
+      t0 = time.perf_counter()
+      from DeepMRAC import predict_DeepUTE
+      model = predict_DeepUTE
+      print(f"Model loaded in {time.perf_counter()-t0:.2f} s")
+   return model
 
 def nda2dcm(DeepX,umap_orig):  
-   dcm = [] # ready list
    maxVal = int(DeepX.max()) # find max value of output
    newSIUID = dicom.uid.generate_uid(prefix='1.3.12.2.1107.5.2.38.51014.') # generate new Series Instance uid
 
-   # Read each file in UMAP container, replace relevant tags
-   for f in os.listdir(umap_orig):
-      ds=dicom.read_file(os.path.join(umap_orig,f))
+   # Read headers of the UMAP container once, without pixel data
+   with ThreadPoolExecutor(max_workers=load_workers) as ex:
+      dcm = list(ex.map(lambda f: dicom.dcmread(f, stop_before_pixels=True), dicom_files(umap_orig)))
+   if not dcm:
+      return dcm
+
+   # cast the whole volume once, each slice's pixel data is a view into it
+   vol = np.ascontiguousarray(DeepX, dtype=pixel_dtype(dcm[0]))
+   vr = 'OB' if int(dcm[0].BitsAllocated) <= 8 else 'OW'
 
+   # replace relevant tags and pixel data
+   for ds in dcm:
       # get z index
       z = int(ds.InstanceNumber)-1
 
@@ -61,21 +68,47 @@ def nda2dcm(DeepX,umap_orig):
       ds.SeriesDescription = "DeepUTE"
       ds.SeriesNumber = "505"
       ds.SOPInstanceUID = dicom.uid.generate_uid(prefix='1.3.12.2.1107.5.2.38.51014.')
-      ds.LargestImagePixelValue = maxVal
-      ds.PixelData = DeepX[z,:,:].astype(ds.pixel_array.dtype).tobytes() # Inserts actual image info
-
-      # append dicom to list
-      dcm.append(ds)
+      # explicit VR, read as implicit VR it is left ambiguous and can not be encoded
+      ds.add_new('LargestImagePixelValue', 'SS' if ds.get('PixelRepresentation') else 'US', maxVal)
+      ds.add_new('PixelData', vr, memoryview(vol[z]).cast('B')) # Inserts actual image info
    
    # return dicoms
    return dcm
 
-def dcm2nda(path):
-   vol = np.empty((192,192,192), dtype=float)
-   for filename in os.listdir(path):
-      ds = dicom.dcmread(os.path.join(path, filename))
-      z = int(ds.InstanceNumber)-1
-      vol[z,:,:] = ds.pixel_array
+def read_index(path):
+   # per-series index from the sorter, with pixel data offsets
+   try:
+      with open(os.path.join(path, index_file)) as fp:
+         return json.load(fp)['files']
+   except (OSError, ValueError, KeyError):
+      return None
+
+def dicom_files(path):
+   return [os.path.join(path, f) for f in sorted(os.listdir(path)) if f != index_file]
+
+def dcm2nda(path, dtype=input_dtype, workers=load_workers):
+   index = read_index(path)
+   if index and all(e.get('offset') is not None for e in index):
+      # memory map pixel data straight from the files, no header parsing
+      vol = np.empty((len(index), *index[0]['shape']), dtype=dtype)
+      def load_slice(e):
+         z = int(e['InstanceNumber'])-1
+         vol[z,:,:] = np.memmap(os.path.join(path, e['path']), dtype=e['dtype'], mode='r', offset=e['offset'], shape=tuple(e['shape']))
+      slices = index
+   else:
+      files = dicom_files(path)
+      # volume shape from the headers, one slice per file
+      ds = dicom.dcmread(files[0], stop_before_pixels=True)
+      vol = np.empty((len(files), int(ds.Rows), int(ds.Columns)), dtype=dtype)
+      def load_slice(filename):
+         ds = dicom.dcmread(filename)
+         z = int(ds.InstanceNumber)-1
+         vol[z,:,:] = ds.pixel_array
+      slices = files
+
+   # decode slices in parallel, straight into the preallocated volume
+   with ThreadPoolExecutor(max_workers=workers) as ex:
+      list(ex.map(load_slice, slices))
    return vol
 
 def get_paths(path):
@@ -87,38 +120,75 @@ def get_paths(path):
    return ute1_path, ute2_path, umap_path
 
 
-def process_ute(path):
+def load_ute(path):
 	#read json
    with open(os.path.join(path,json_file)) as file:
       studyinfo = json.load(file)
 
    ute1_path, ute2_path, umap_path = get_paths(path)
 
-   # process data
+   t0 = time.perf_counter()
    ute1 = dcm2nda(ute1_path)
    ute2 = dcm2nda(ute2_path)
-   print("UTE loaded")
+   print(f"UTE loaded {ute1.shape} in {time.perf_counter()-t0:.2f} s")
+   return studyinfo, ute1, ute2, umap_path
+
+def predict_ute(path, studyinfo, ute1, ute2, umap_path):
+   # process data
+   t1 = time.perf_counter()
+   predict_DeepUTE = warmup()
    DeepX = predict_DeepUTE(ute1,ute2,'VE11P')
-   print("uMap generated")
+   print(f"uMap generated in {time.perf_counter()-t1:.2f} s")
    umap = nda2dcm(DeepX, umap_path)
     
-   # send result
-   if len(umap) == 192:
-      #send_dicom(umap, studyinfo['Remote_Host'], 104, studyinfo['Remote_AET'], local_aet)
-      send_dicom(umap, ip_adr, 104, studyinfo['Remote_AET'], local_aet)
-   else:
-      print(f"Processing of {path} failed")
+   # send result, one slice of the UMAP series for each plane of the volume
+   if not umap or len(umap) != DeepX.shape[0]:
+      raise RuntimeError(f"Processing of {path} failed, {len(umap)} UMAP slices for {DeepX.shape[0]} planes")
+   #sender.send(umap, studyinfo['Remote_Host'], 104, studyinfo['Remote_AET'])
+   sender.send(umap, ip_adr, remote_port, studyinfo['Remote_AET'])
+
+def process_ute(path):
+   predict_ute(path, *load_ute(path))
+
+def process_batch(paths):
+   # the next studies are loaded while the model runs on the ones already
+   # loaded. the model stays loaded in this process between batches
+   t0 = time.perf_counter()
+   status = []
+   with ThreadPoolExecutor(max_workers=batch_loaders) as ex:
+      loaded = [ex.submit(load_ute, path) for path in paths]
+      for path, future in zip(paths, loaded):
+         try:
+            predict_ute(path, *future.result())
+            status.append('done')
+         except Exception:
+            traceback.print_exc()
+            status.append('failed')
+         print(f"{path} finished {time.perf_counter()-t0:.2f} s into batch of {len(paths)}")
+   return status
 
 # start monitoring data folder
 if __name__ == "__main__":
    if len(sys.argv) > 1:
       process_ute(sys.argv[1])
       exit()
+   warmup()
+   # the model lives in this process, so jobs are run in threads instead of
+   # forked processes
+   jobs = JobScheduler(process_batch, timeout=job_timeout, queue_file=queue_file, isolate=False, batch_size=batch_size, processed_file=processed_file, first_run_file=first_run_file)
    i = Inotify()
    for m in monitor:
       i.add_watch(m, IN_CREATE)
       print(f"Monitoring '{m}'")
-   for event in i.event_gen(yield_nones=False):
+   sender.retry()
+   jobs.restore()
+   for m in monitor:
+      jobs.recover(m, json_file, watch=lambda path: i.add_watch(path, IN_CREATE))
+   for event in i.event_gen(yield_nones=True):
+      if event is None:
+         # between events, retry queued sends once per retry_interval
+         sender.retry()
+         continue
       (id, type_names, path, filename) = event
       
       # if new folder, watch for json file.
@@ -129,4 +199,4 @@ if __name__ == "__main__":
             i.add_watch(new_path, IN_CREATE)
       elif filename == json_file:
          i.remove_watch(path)
-         process_ute(path)
+         jobs.submit(path)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts'))
+import pydicom
+from rules import RuleSet
+
+def make_rules(n, literal_fraction=0.9):
+	# mostly exact series description matches, as in deepmrac.json, with
+	# some free regex rules mixed in
+	rules = []
+	for i in range(n):
+		if random.random() < literal_fraction:
+			test = f"dicom(SeriesDescription):regex(^Series_{i:04d}$)"
+		else:
+			test = f"dicom(ProtocolName):regex(^.*(proto_{i:04d}_[0-9]{{1,3}}V).*$)"
+		rules.append({
+			'name': f"rule {i}",
+			'destination': "{isotime}/{SeriesNumber}-{SeriesDescription}/{InstanceNumber:05d}.dcm",
+			'action': 'tst',
+			'tests': [test],
+		})
+	rules.append({
+		'name': 'Study info JSON',
+		'destination': '{isotime}/{filename}',
+		'requirement': 'n=1',
+		'action': 'tst',
+		'tests': ["fileinfo(filename):regex((studyinfo\\.json))"],
+	})
+	return rules
+
+def make_files(n_files, n_rules):
+	files = []
+	for i in range(n_files):
+		ds = pydicom.Dataset()
+		k = random.randrange(int(n_rules*1.2)) # some files match no rule
+		ds.SeriesDescription = f"Series_{k:04d}"
+		ds.ProtocolName = f"x_proto_{k:04d}_{k%200}V_y"
+		ds.SeriesNumber = k
+		ds.InstanceNumber = i
+		files.append({
+			'studyinfo': {},
+			'fileinfo': {'isotime': 'bench', 'filename': f"MR.{i}", 'abspath': f"/scratch/MR.{i}", 'relpath': '/scratch'},
+			'dicom': ds,
+			'isDicom': True,
+		})
+	return files
+
+def run(ruleset, files):
+	ruleset.staged = []
+	t0 = time.perf_counter()
+	for metadata in files:
+		ruleset.testFile(metadata)
+	return time.perf_counter() - t0, (ruleset.staged, [r.n for r in ruleset.rules])
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare linear and indexed rule matching')
+	parser.add_argument('--rules', type=int, nargs='+', default=[10, 100, 500])
+	parser.add_argument('--files', type=int, default=2000)
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+	random.seed(args.seed)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		for n in args.rules:
+			rulefile = os.path.join(tmp, f"bench{n}.json")
+			with open(rulefile, 'w') as fp:
+				json.dump(make_rules(n), fp)
+			files = make_files(args.files, n)
+			t_linear, linear = run(RuleSet(rulefile, compiled=False), files)
+			t_indexed, indexed = run(RuleSet(rulefile), files)
+			same = linear == indexed
+			print(f"{n:5d} rules  linear {t_linear/len(files)*1e6:8.1f} us/file  indexed {t_indexed/len(files)*1e6:8.1f} us/file  x{t_linear/t_indexed:5.1f}  identical={same}")
+
+if __name__ == '__main__':
+	main()
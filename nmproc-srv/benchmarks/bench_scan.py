@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import tempfile
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts'))
+from helpers import finddirs, findfiles
+from dicom_sorter import scan_files, collect_tags
+from rules import RuleSet
+from synthetic import make_study
+
+rulesdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts', 'rulesets')
+
+def timed_scan(files, workers, pool, tags=None):
+	t0 = time.perf_counter()
+	paths = [m['fileinfo']['abspath'] for m in scan_files(files, {}, 'bench', workers, pool, tags)]
+	return time.perf_counter() - t0, paths
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare serial and parallel header scanning')
+	parser.add_argument('--path', help='existing study folder (default: synthetic study in a temp folder)')
+	parser.add_argument('--size', type=int, default=192, help='rows/columns of synthetic slices')
+	parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8])
+	parser.add_argument('--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tmp:
+		path = args.path
+		if path is None:
+			path = os.path.join(tmp, 'study')
+			make_study(path, size=args.size)
+		files = findfiles(finddirs(path))
+		print(f"{len(files)} files in {path}")
+
+		_, reference = timed_scan(files, 1, 'thread')
+		serial = min(timed_scan(files, 1, 'thread')[0] for _ in range(args.repeat))
+		print(f"serial        {serial*1000:8.1f} ms  {len(files)/serial:8.0f} files/s")
+		tags = collect_tags([RuleSet(os.path.join(rulesdir, f)) for f in sorted(os.listdir(rulesdir)) if f.endswith('.json')])
+		subset = min(timed_scan(files, 1, 'thread', tags)[0] for _ in range(args.repeat))
+		print(f"serial subset {subset*1000:8.1f} ms  {len(files)/subset:8.0f} files/s  x{serial/subset:4.2f}  ({len(tags)} tags)")
+		for pool in ('thread', 'process'):
+			for workers in args.workers:
+				runs = [timed_scan(files, workers, pool) for _ in range(args.repeat)]
+				best = min(t for t, _ in runs)
+				ordered = all(paths == reference for _, paths in runs)
+				print(f"{pool:7} j={workers:<3} {best*1000:8.1f} ms  {len(files)/best:8.0f} files/s  x{serial/best:4.2f}  ordered={ordered}")
+
+if __name__ == '__main__':
+	main()
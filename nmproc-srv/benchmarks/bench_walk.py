@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import tempfile
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts'))
+from helpers import finddirs, findfiles, walkfiles
+
+def make_tree(path, depth, width, files):
+	# every folder holds `files` files and `width` subfolders, down to `depth`
+	os.makedirs(path, exist_ok=True)
+	for i in range(files):
+		open(os.path.join(path, f"MR.{i:05d}"), 'w').close()
+	if depth > 0:
+		for i in range(width):
+			make_tree(os.path.join(path, f"d{i:03d}"), depth-1, width, files)
+
+def best(fn, repeat):
+	times = []
+	for _ in range(repeat):
+		t0 = time.perf_counter()
+		result = fn()
+		times.append(time.perf_counter() - t0)
+	return min(times), result
+
+def main():
+	parser = argparse.ArgumentParser(description='Compare finddirs/findfiles with walkfiles')
+	parser.add_argument('--repeat', type=int, default=5)
+	args = parser.parse_args()
+
+	trees = {
+		'wide (1 folder, 5000 files)': (0, 0, 5000),
+		'series (20 folders, 400 files)': (1, 20, 400),
+		'deep (4 levels x 4, 20 files)': (4, 4, 20),
+	}
+	with tempfile.TemporaryDirectory() as tmp:
+		for name, (depth, width, files) in trees.items():
+			root = os.path.join(tmp, name.split()[0])
+			make_tree(root, depth, width, files)
+			t_old, old = best(lambda: findfiles(finddirs(root)), args.repeat)
+			t_new, new = best(lambda: list(walkfiles(root)), args.repeat)
+			print(f"{name:32} {len(new):6d} files  finddirs/findfiles {t_old*1000:7.1f} ms  walkfiles {t_new*1000:7.1f} ms  x{t_old/t_new:4.1f}  same={old == new}")
+
+if __name__ == '__main__':
+	main()
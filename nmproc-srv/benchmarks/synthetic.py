@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import os
+import json
+import argparse
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+# series layout of a Siemens mMR DeepMRAC association, two UTE echoes
+# and the vendor UMAP
+mmr_series = [
+	(2, 'Head_MRAC_UTE', 192),
+	(3, 'Head_MRAC_UTE', 192),
+	(4, 'Head_MRAC_UTE_UMAP', 192),
+]
+
+def make_slice(study_uid, series_uid, series_number, description, instance, size):
+	file_meta = FileMetaDataset()
+	file_meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+	file_meta.MediaStorageSOPInstanceUID = generate_uid()
+	file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+	ds = Dataset()
+	ds.file_meta = file_meta
+	ds.is_little_endian = True
+	ds.is_implicit_VR = False
+	ds.SpecificCharacterSet = 'ISO_IR 100'
+	ds.SOPClassUID = MR_IMAGE_STORAGE
+	ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+	ds.StudyDate = '20220101'
+	ds.Modality = 'MR'
+	ds.Manufacturer = 'SIEMENS'
+	ds.StationName = 'MRC51014'
+	ds.StudyDescription = 'Synthetic^Study'
+	ds.SeriesDescription = description
+	ds.PatientName = 'Synthetic^Patient'
+	ds.PatientID = '0000000000'
+	ds.ProtocolName = description
+	ds.StudyInstanceUID = study_uid
+	ds.SeriesInstanceUID = series_uid
+	ds.StudyID = '1'
+	ds.SeriesNumber = series_number
+	ds.InstanceNumber = instance
+	ds.SamplesPerPixel = 1
+	ds.PhotometricInterpretation = 'MONOCHROME2'
+	ds.Rows = size
+	ds.Columns = size
+	ds.BitsAllocated = 16
+	ds.BitsStored = 12
+	ds.HighBit = 11
+	ds.PixelRepresentation = 0
+	ds.PixelData = np.full((size, size), instance, dtype=np.uint16).tobytes()
+	return ds
+
+def make_study(path, series=mmr_series, size=192, studyinfo=None):
+	# write a study in the same layout storescp leaves in the scratch folder
+	os.makedirs(path, exist_ok=True)
+	study_uid = generate_uid()
+	files = []
+	for series_number, description, n in series:
+		series_uid = generate_uid()
+		for instance in range(1, n+1):
+			ds = make_slice(study_uid, series_uid, series_number, description, instance, size)
+			filename = os.path.join(path, f"MR.{ds.SOPInstanceUID}")
+			ds.save_as(filename, write_like_original=False)
+			files.append(filename)
+	if studyinfo is not None:
+		with open(os.path.join(path, 'studyinfo.json'), 'w') as fp:
+			json.dump(studyinfo, fp, indent=3)
+	return files
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Write a synthetic mMR UTE/UMAP study')
+	parser.add_argument('path')
+	parser.add_argument('--size', type=int, default=192)
+	args = parser.parse_args()
+	files = make_study(args.path, size=args.size, studyinfo={'Local_AET': 'NMPROC', 'Remote_AET': 'SYNTH', 'Remote_Host': '127.0.0.1'})
+	print(f"Wrote {len(files)} files to {args.path}")
@@ -0,0 +1,58 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+
+modes = ['off', 'skip', 'link']
+
+def file_digest(path, chunk=1<<20):
+	h = hashlib.sha1()
+	with open(path, 'rb') as fp:
+		for block in iter(lambda: fp.read(chunk), b''):
+			h.update(block)
+	return h.hexdigest()
+
+# instances that have been sorted, by SOPInstanceUID, with the path they
+# were sorted to and optionally a hash of their content. kept in a sqlite
+# file in the data folder, so it survives restarts and can be shared by
+# the sorter daemon and sort.sh. a read-only index (for dry runs) must
+# already exist
+class DedupIndex:
+	def __init__(self, path, readonly=False):
+		self.path = path
+		self.lock = threading.Lock()
+		if readonly:
+			self.db = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True, timeout=30, check_same_thread=False)
+			return
+		os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+		self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS instances (uid TEXT PRIMARY KEY, path TEXT NOT NULL, digest TEXT, time REAL)')
+		self.db.commit()
+
+	def find(self, uid, digest=None):
+		# path of a sorted copy of the instance, None if the instance is new,
+		# its content has changed or the sorted copy has been removed
+		with self.lock:
+			row = self.db.execute('SELECT path, digest FROM instances WHERE uid = ?', (uid,)).fetchone()
+		if row is None:
+			return None
+		path, known = row
+		if digest is not None and known is not None and digest != known:
+			return None
+		if not os.path.isfile(path):
+			return None
+		return path
+
+	def add(self, entries):
+		# (uid, path, digest) of sorted instances, a later copy replaces the
+		# earlier one
+		now = time.time()
+		with self.lock:
+			self.db.executemany('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)', [(uid, path, digest, now) for uid, path, digest in entries])
+			self.db.commit()
+
+	def close(self):
+		with self.lock:
+			self.db.close()
@@ -4,23 +4,144 @@ import sys
 import os
 import re
 import json
-from helpers import finddirs, findfiles
-from rules import RuleSet
+import time
+import argparse
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from helpers import walkfiles, read_header
+from rules import RuleSetCache
+from metrics import export_metrics
+from dedup import DedupIndex, file_digest, modes as dedup_modes
 from datetime import datetime
 
-def main():
-	rulesets = []
-	rulesdir = os.path.join(os.path.dirname(os.path.realpath(__file__)),'rulesets')
-	for f in os.listdir(rulesdir):
-		if f.endswith('.json'):
-			print(f)
-			rulefile = os.path.join(rulesdir,f)
-			rulesets.append(RuleSet(rulefile))
-
-	searchpath = sys.argv[1]
-	files = findfiles(finddirs(searchpath))
-	
-	data_out = sys.argv[2]
+SOP_INSTANCE_UID = pydicom.tag.Tag('SOPInstanceUID')
+
+def collect_tags(rulesets):
+	return sorted(pydicom.tag.Tag(t) for t in set().union(*[rs.tags for rs in rulesets]))
+
+def file_metadata(path, studyinfo, isotime):
+	metadata = {}
+	metadata['studyinfo'] = studyinfo.copy() # copy data from json file
+	metadata['fileinfo'] = {
+		'isotime' : isotime,
+		'filename': os.path.basename(path),
+		'abspath' : os.path.abspath(path),
+		'relpath' : os.path.dirname(path)
+	}
+	# split relative path into folders
+	for lvl, folder in enumerate(filter(lambda x: x != "", reversed(metadata['fileinfo']['relpath'].split('/')))):
+		metadata['fileinfo']['relpath%d'%lvl] = folder
+	return metadata
+
+def read_metadata(path, studyinfo, isotime, tags=None, digest=False):
+	metadata = file_metadata(path, studyinfo, isotime)
+	t0 = time.perf_counter()
+	try:
+		metadata['dicom'], metadata['pixeldata'] = read_header(path, tags)
+		metadata['isDicom'] = True
+		if digest:
+			metadata['digest'] = file_digest(path)
+	except:
+		metadata['isDicom'] = False
+		metadata['dicom'] = {}
+	metadata['parsetime'] = time.perf_counter() - t0
+	return metadata
+
+def scan_files(files, studyinfo, isotime, workers=1, pool='thread', tags=None, digest=False):
+	# read headers serially, or with a pool of workers. results are always
+	# yielded in the same order as files, and only a bounded number of
+	# reads are in flight so memory does not grow with the study size
+	read = partial(read_metadata, studyinfo=studyinfo, isotime=isotime, tags=tags, digest=digest)
+	if workers <= 1:
+		for path in files:
+			yield read(path)
+		return
+	executor = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+	with executor(max_workers=workers) as ex:
+		pending = deque()
+		for path in files:
+			pending.append(ex.submit(read, path))
+			if len(pending) >= workers*4:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description='Sort DICOM files according to rulesets')
+	parser.add_argument('searchpath', help='folder with received files')
+	parser.add_argument('data_out', help='root folder for sorted files')
+	parser.add_argument('-j', '--workers', type=int, default=1, help='number of concurrent header readers')
+	parser.add_argument('--pool', choices=['thread','process'], default='thread', help='type of worker pool used when workers > 1')
+	parser.add_argument('--all-tags', action='store_true', help='read complete headers instead of only the tags used by the rulesets')
+	parser.add_argument('--plan', metavar='FILE', help='write the sort plan with rule matches, actions and timings as json')
+	parser.add_argument('--metrics', metavar='FILE', help='append phase timings and match counts as a json line')
+	parser.add_argument('--prom', metavar='FILE', help='write phase timings and match counts in prometheus text format')
+	parser.add_argument('-n', '--dry-run', action='store_true', help='test rules and requirements, but do not touch any files')
+	add_dedup_args(parser)
+	return parser.parse_args(argv)
+
+def add_dedup_args(parser):
+	parser.add_argument('--dedup', choices=dedup_modes, default='off', help='skip instances that have been sorted before, or link them to the sorted copy. skip only works with rulesets without requirements')
+	parser.add_argument('--dedup-db', metavar='FILE', help='index of sorted instances, default .dedup.sqlite in data_out')
+	parser.add_argument('--dedup-hash', action='store_true', help='also compare file contents, a changed instance is sorted again')
+
+def open_dedup(mode, data_out, path=None, readonly=False):
+	# read-only opens nothing if the index has not been created yet
+	path = path or os.path.join(data_out, '.dedup.sqlite')
+	if mode == 'off' or (readonly and not os.path.isfile(path)):
+		return None
+	return DedupIndex(path, readonly)
+
+def check_dedup_mode(mode, rulesets):
+	# skipped duplicates are not staged, so a study re-sent with a new series
+	# would be sorted without the series it already had. rulesets with
+	# requirements need all files of the study, use link for those
+	names = [rs.name for rs in rulesets if any(r.requirement for r in rs.rules)]
+	if mode == 'skip' and names:
+		raise ValueError(f"--dedup skip cannot be used with rulesets that have requirements ({', '.join(names)}), use --dedup link")
+
+def find_duplicate(dedup, metadata):
+	# SOPInstanceUID of a dicom file and the path of its sorted copy, if it
+	# has been sorted before
+	uid = metadata['dicom'].get(SOP_INSTANCE_UID) if metadata['isDicom'] else None
+	if uid is None:
+		return None, None
+	uid = str(uid.value)
+	return uid, dedup.find(uid, metadata.get('digest'))
+
+def finish_rulesets(rulesets, data_out, dry_run=False, dedup=None, instances=None):
+	# if requirements are met, do staged actions. returns the plan of each
+	# ruleset, and adds the sorted instances to dedup
+	entries = []
+	for ruleset in rulesets:
+		t0 = time.perf_counter()
+		results = None
+		if ruleset.testRequirements() and not dry_run:
+			results = ruleset.doActions(data_out)
+		entry = ruleset.plan(data_out, results)
+		entry['done'] = results is not None
+		entry['timings'] = dict(ruleset.timings, action=time.perf_counter() - t0)
+		entries.append(entry)
+		if results is not None and dedup is not None:
+			sorted_instances = [(src, dest) for src, dest, e in results if e is None and src in instances]
+			dedup.add([(instances[src][0], dest, instances[src][1]) for src, dest in sorted_instances])
+	return entries
+
+rulesdir = os.path.join(os.path.dirname(os.path.realpath(__file__)),'rulesets')
+
+def load_rulesets(path=rulesdir):
+	return RuleSetCache(path).load()
+
+def sort_folder(searchpath, data_out, rulesets, workers=1, pool='thread', tags=None, progress=True, dry_run=False, dedup=None, dedup_mode='link', digest=False):
+	if dedup is not None:
+		check_dedup_mode(dedup_mode, rulesets)
+	# work on clones, the loaded rulesets may be shared between jobs
+	rulesets = [rs.clone() for rs in rulesets]
+	timings = {}
+	t_start = t0 = time.perf_counter()
+	files = list(walkfiles(searchpath))
+	timings['walk'] = time.perf_counter() - t0
 
 	#read info.json
 	try:
@@ -31,43 +152,95 @@ def main():
 
 	isotime = datetime.now().isoformat()
 
+	# instances already in dedup are skipped, or linked to the sorted copy
+	if dedup is not None and tags is not None:
+		tags = sorted(set(tags) | {SOP_INSTANCE_UID})
+	digest = digest and dedup is not None
+	instances = {} # staged source -> (SOPInstanceUID, digest)
+	duplicates = 0
+	skipped = [] # duplicates that would have been moved
+
+	# scan and test files one at a time, only the staged actions are kept
 	n = len(files)
+	if progress:
+		print('')
 	n_dcm = 0
-	print('')
-	metadata_collection = []
-	for i,path in zip(range(n),files):
-		sys.stdout.write("\rScanning files %000d/%000d"%(i+1,n))
-		sys.stdout.flush()
-		metadata = {}
-		metadata['studyinfo'] = studyinfo.copy() # copy data from json file
-		metadata['fileinfo'] = {
-			'isotime' : isotime,
-			'filename': os.path.basename(path),
-			'abspath' : os.path.abspath(path),
-			'relpath' : os.path.dirname(path)
-		}
-		# split relative path into folders
-		for lvl, folder in enumerate(filter(lambda x: x != "", reversed(metadata['fileinfo']['relpath'].split('/')))):
-			metadata['fileinfo']['relpath%d'%lvl] = folder
-		try:
-			dcmfile = pydicom.filereader.read_file(path, stop_before_pixels=True)
-			metadata['dicom'] = dcmfile
-			metadata['isDicom'] = True
-		except:
-			metadata['isDicom'] = False
-			metadata['dicom'] = {}
-		# test file
-		metadata_collection.append(metadata)
-	sys.stdout.write('\n')
-
-	# perform tests	
-	for ruleset in rulesets:
-		for metadata in metadata_collection:
+	parse = 0.0
+	timings['dedup'] = 0.0
+	t0 = time.perf_counter()
+	for i, metadata in enumerate(scan_files(files, studyinfo, isotime, workers, pool, tags, digest)):
+		if progress:
+			sys.stdout.write("\rScanning files %000d/%000d"%(i+1,n))
+			sys.stdout.flush()
+		n_dcm += metadata['isDicom']
+		parse += metadata['parsetime']
+		uid = None
+		if dedup is not None:
+			t1 = time.perf_counter()
+			uid, sorted_path = find_duplicate(dedup, metadata)
+			timings['dedup'] += time.perf_counter() - t1
+		if uid is not None:
+			if sorted_path is not None:
+				duplicates += 1
+				if dedup_mode == 'skip':
+					if any(rule is not None and rule.action == 'mv' for rule in (rs.findRule(metadata) for rs in rulesets)):
+						skipped.append(metadata['fileinfo']['abspath'])
+					continue
+				metadata['duplicate'] = sorted_path
+			instances[sorted_path or metadata['fileinfo']['abspath']] = (uid, metadata.get('digest'))
+		for ruleset in rulesets:
 			ruleset.testFile(metadata)
-	# if tests succesful, do action
-		if ruleset.testRequirements():
-			for metadata in metadata_collection:
-				ruleset.doAction(metadata, data_out)
+	# wall time of the scan loop without rule testing, and summed header
+	# parse time of all workers
+	timings['scan'] = time.perf_counter() - t0 - timings['dedup'] - sum(rs.timings['test'] + rs.timings['format'] for rs in rulesets)
+	timings['parse'] = parse
+	if progress:
+		sys.stdout.write('\n')
+	else:
+		print(f"Scanned {n} files in {searchpath}")
+	if duplicates:
+		print(f"{duplicates} instances have been sorted before ({dedup_mode})")
+
+	# if requirements are met, do staged actions
+	plan = {
+		'searchpath': searchpath,
+		'data_out': data_out,
+		'isotime': isotime,
+		'files': n,
+		'dicom_files': n_dcm,
+		'duplicates': duplicates,
+		'dry_run': dry_run,
+		'timings': timings,
+		'rulesets': finish_rulesets(rulesets, data_out, dry_run, dedup, instances),
+	}
+	# skipped duplicates are taken out of the search path, as a move would
+	if not dry_run:
+		for path in skipped:
+			try:
+				os.remove(path)
+			except OSError as e:
+				print(f"Could not remove {path}: {e}")
+	if skipped:
+		print(f"{'Would remove' if dry_run else 'Removed'} {len(skipped)} duplicates from {searchpath}")
+	timings['total'] = time.perf_counter() - t_start
+	return plan
+
+def main():
+	args = parse_args()
+	rulesets = load_rulesets()
+	try:
+		check_dedup_mode(args.dedup, rulesets)
+	except ValueError as e:
+		sys.exit(str(e))
+	tags = None if args.all_tags else collect_tags(rulesets)
+	dedup = open_dedup(args.dedup, args.data_out, args.dedup_db, readonly=args.dry_run)
+	plan = sort_folder(args.searchpath, args.data_out, rulesets, args.workers, args.pool, tags, dry_run=args.dry_run, dedup=dedup, dedup_mode=args.dedup, digest=args.dedup_hash)
+	if dedup is not None:
+		dedup.close()
+	if args.plan:
+		with open(args.plan, 'w') as fp:
+			json.dump(plan, fp, indent=3)
+	export_metrics(plan, args.metrics, args.prom)
 
 if __name__ == '__main__':
 	main()
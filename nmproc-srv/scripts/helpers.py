@@ -1,6 +1,13 @@
 import os
+import json
+import errno
 import shutil
 import operator
+import pydicom
+from concurrent.futures import ThreadPoolExecutor
+
+PIXEL_DATA = pydicom.tag.Tag('PixelData')
+PIXEL_TAGS = {pydicom.tag.Tag(kw) for kw in ('FloatPixelData', 'DoubleFloatPixelData', 'PixelData')}
 
 def finddirs(path):
 	dirs = []
@@ -20,9 +27,60 @@ def findfiles(paths):
 				files.append(filepath)
 	return files
 
+def walkfiles(path):
+	# same files and order as findfiles(finddirs(path)), but lazy and
+	# using the file types from scandir instead of a stat per entry
+	with os.scandir(path) as it:
+		entries = sorted(it, key=lambda e: e.name)
+	for entry in entries:
+		if entry.is_dir():
+			yield from walkfiles(entry.path)
+	for entry in entries:
+		if entry.is_file():
+			yield entry.path
+
+def read_header(path, tags=None):
+	with open(path, 'rb') as fp:
+		return parse_header(fp, tags)
+
+def parse_header(fp, tags=None):
+	# returns the dataset and the (offset, length) of the pixel data if the
+	# reader got as far as the pixel data element, without reading it
+	pixeldata = []
+	def at_pixel_data(tag, VR, length):
+		if tag == PIXEL_DATA and length > 0:
+			pixeldata.append((fp.tell(), length))
+		return tag in PIXEL_TAGS
+	# without a tag list, read everything up to the pixel data
+	stop = at_pixel_data
+	if tags is not None:
+		# elements are stored in ascending tag order, so stop reading once
+		# the last wanted tag has been passed, and skip the values of all
+		# others
+		last = max(tags, default=0)
+		stop = lambda tag, VR, length: at_pixel_data(tag, VR, length) or tag > last
+	ds = pydicom.filereader.read_partial(fp, stop_when=stop, specific_tags=tags)
+	return ds, (pixeldata[0] if pixeldata else None)
+
+def _symlink(src, dest):
+   os.symlink(os.path.relpath(src,os.path.split(dest)[0]),dest)
+
 def _link(src, dest):
    _makePath(dest)
-   os.symlink(os.path.relpath(src,os.path.split(dest)[0]),dest)
+   _symlink(src, dest)
+
+def _hardlink(src, dest):
+   # share the file of an earlier copy, or link to it from another filesystem
+   try:
+      os.link(src, dest)
+   except OSError as e:
+      if e.errno != errno.EXDEV:
+         raise
+      _symlink(src, dest)
+
+def _relink(src, dest):
+   _makePath(dest)
+   _hardlink(src, dest)
 
 def _copy(src, dest):
    _makePath(dest)
@@ -43,6 +101,74 @@ def _makePath(path):
 	if not os.path.exists(dirpath):
 		os.makedirs(dirpath)
 
+def batch_actions(items, workers=4):
+	# do a list of (src, dest, action) and return (src, dest, error) for
+	# each, in the same order. destination folders are created once, moves
+	# within a filesystem are plain renames and moves/copies between
+	# filesystems run in a thread pool. the last item is done after all
+	# others have finished, so a trailing studyinfo.json still marks a
+	# complete study.
+	results = [None]*len(items)
+	devices = {}
+	def device(dirpath):
+		if dirpath not in devices:
+			devices[dirpath] = os.stat(dirpath).st_dev
+		return devices[dirpath]
+
+	def run(i, fn, src, dest):
+		try:
+			fn(src, dest)
+			results[i] = (src, dest, None)
+		except Exception as e:
+			results[i] = (src, dest, e)
+
+	# create each destination folder once
+	dir_errors = {}
+	for dirpath in sorted({os.path.dirname(dest) for src, dest, action in items if action in batch_nodirs}):
+		try:
+			os.makedirs(dirpath, exist_ok=True)
+		except OSError as e:
+			dir_errors[dirpath] = e
+
+	with ThreadPoolExecutor(max_workers=max(1,workers)) as ex:
+		pending = []
+		for i, (src, dest, action) in enumerate(items):
+			dirpath = os.path.dirname(dest)
+			if dirpath in dir_errors and action in batch_nodirs:
+				results[i] = (src, dest, dir_errors[dirpath])
+				continue
+			fn = batch_nodirs.get(action, actions[action])
+			background = fn is shutil.copy
+			if action == 'mv':
+				try:
+					background = device(os.path.dirname(src)) != device(dirpath)
+				except OSError:
+					background = True
+				fn = shutil.move if background else os.rename
+			if i == len(items)-1:
+				for f in pending:
+					f.result()
+				background = False
+			if background:
+				pending.append(ex.submit(run, i, fn, src, dest))
+			else:
+				run(i, fn, src, dest)
+	return results
+
+def write_series_index(entries, filename='series_index.json'):
+	# one index per destination folder, entries sorted by instance number
+	folders = {}
+	for entry in entries:
+		folders.setdefault(os.path.dirname(entry['path']), []).append(entry)
+	for folder, files in folders.items():
+		files = sorted(files, key=lambda e: (e.get('InstanceNumber') is None, e.get('InstanceNumber') or 0))
+		files = [dict(e, path=os.path.basename(e['path'])) for e in files]
+		try:
+			with open(os.path.join(folder, filename), 'w') as fp:
+				json.dump({'files': files}, fp)
+		except OSError as e:
+			print(f"\tCould not write index in {folder}: {e}")
+
 
 operators = {
 	'>':	operator.gt,
@@ -54,9 +180,17 @@ operators = {
 
 actions = {
 	'ln':  _link,
+	'hl':  _relink,
 	'mv':  _move,
 	'cp':  _copy,
 	'rm':  _del,
 	'tst': _print
 }
 
+# actions without _makePath, used by batch_actions after creating the folders
+batch_nodirs = {
+	'ln':  _symlink,
+	'hl':  _hardlink,
+	'mv':  shutil.move,
+	'cp':  shutil.copy,
+}
@@ -0,0 +1,77 @@
+import os
+import json
+import time
+import threading
+
+# phases reported for every sorted folder, summed over all rulesets
+phases = ['walk', 'receive', 'parse', 'scan', 'dedup', 'write', 'test', 'format', 'action', 'total']
+
+def summarize(plan):
+	timings = dict(plan['timings'])
+	for phase in ('test', 'format', 'action'):
+		timings[phase] = sum(rs['timings'][phase] for rs in plan['rulesets'])
+	total = timings['total']
+	return {
+		'timestamp': time.time(),
+		'searchpath': plan['searchpath'],
+		'files': plan['files'],
+		'dicom_files': plan['dicom_files'],
+		'duplicates': plan.get('duplicates', 0),
+		'files_per_second': plan['files']/total if total > 0 else 0.0,
+		'dry_run': plan['dry_run'],
+		'seconds': {phase: timings.get(phase, 0.0) for phase in phases},
+		'rulesets': {rs['name']: {
+			'matched': len(rs['actions']),
+			'requirements': rs['requirements'],
+			'done': rs['done'],
+			'failed': sum(a['error'] is not None for a in rs['actions']),
+		} for rs in plan['rulesets']},
+	}
+
+def write_jsonl(path, record):
+	with open(path, 'a') as fp:
+		fp.write(json.dumps(record) + '\n')
+
+def write_prometheus(path, record):
+	lines = [
+		'# HELP nmproc_sort_phase_seconds Time spent in each phase of the last sort.',
+		'# TYPE nmproc_sort_phase_seconds gauge',
+	]
+	lines += [f'nmproc_sort_phase_seconds{{phase="{phase}"}} {sec:.6f}' for phase, sec in record['seconds'].items()]
+	lines += [
+		'# HELP nmproc_sort_files Files scanned by the last sort.',
+		'# TYPE nmproc_sort_files gauge',
+		f'nmproc_sort_files {record["files"]}',
+		f'nmproc_sort_dicom_files {record["dicom_files"]}',
+		'# HELP nmproc_sort_duplicates Instances in the last sort that had been sorted before.',
+		'# TYPE nmproc_sort_duplicates gauge',
+		f'nmproc_sort_duplicates {record["duplicates"]}',
+		'# HELP nmproc_sort_files_per_second Throughput of the last sort.',
+		'# TYPE nmproc_sort_files_per_second gauge',
+		f'nmproc_sort_files_per_second {record["files_per_second"]:.3f}',
+		'# HELP nmproc_ruleset_matched_files Files matched by each ruleset in the last sort.',
+		'# TYPE nmproc_ruleset_matched_files gauge',
+	]
+	for name, rs in record['rulesets'].items():
+		lines.append(f'nmproc_ruleset_matched_files{{ruleset="{name}"}} {rs["matched"]}')
+	lines += [f'nmproc_ruleset_failed_files{{ruleset="{name}"}} {rs["failed"]}' for name, rs in record['rulesets'].items()]
+	lines += [f'nmproc_ruleset_done{{ruleset="{name}"}} {int(rs["done"])}' for name, rs in record['rulesets'].items()]
+	lines.append(f'nmproc_sort_last_timestamp_seconds {record["timestamp"]:.3f}')
+	# replace atomically, so a scraper never sees a partial file
+	tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+	with open(tmp, 'w') as fp:
+		fp.write('\n'.join(lines) + '\n')
+	os.replace(tmp, path)
+
+def export_metrics(plan, jsonl=None, prom=None):
+	if not (jsonl or prom):
+		return None
+	record = summarize(plan)
+	try:
+		if jsonl:
+			write_jsonl(jsonl, record)
+		if prom:
+			write_prometheus(prom, record)
+	except OSError as e:
+		print(f"Could not write metrics: {e}")
+	return record
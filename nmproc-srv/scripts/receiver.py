@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+import traceback
+from datetime import datetime
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_file_meta_info
+from pynetdicom import AE, evt, AllStoragePresentationContexts, VerificationPresentationContexts, ALL_TRANSFER_SYNTAXES
+from dicom_sorter import rulesdir, check_dedup_mode, collect_tags, file_metadata, find_duplicate, finish_rulesets, add_dedup_args, open_dedup, SOP_INSTANCE_UID
+from rules import RuleSetCache
+from helpers import parse_header
+from metrics import export_metrics
+
+CSA_NON_IMAGE_STORAGE = '1.3.12.2.1107.5.9.1' # siemens spectroscopy and raw data
+
+def register_csa():
+	# pynetdicom only hands C-STOREs of known storage classes to the handler
+	try:
+		from pynetdicom.sop_class import register_uid
+		from pynetdicom.service_class import StorageServiceClass
+		register_uid(CSA_NON_IMAGE_STORAGE, 'SiemensCSANonImageStorage', StorageServiceClass)
+	except ImportError:
+		# pynetdicom < 2.1
+		from pynetdicom import sop_class
+		sop_class._STORAGE_CLASSES['SiemensCSANonImageStorage'] = CSA_NON_IMAGE_STORAGE
+
+def encode_file(event):
+	# the received dataset as a dicom file, without decoding it
+	fp = DicomBytesIO()
+	fp.write(b'\0'*128 + b'DICM')
+	write_file_meta_info(fp, event.file_meta, enforce_standard=True)
+	fp.write(event.request.DataSet.getvalue())
+	return fp.getvalue()
+
+# one association, sorted while it is received. instances are written to a
+# staging folder on the same filesystem as data_out, and tested against the
+# rulesets as they arrive. on release studyinfo.json is added last, as
+# sort.sh does, and the staged actions of the rulesets whose requirements
+# are met are done, which are renames within the filesystem
+class Study:
+	def __init__(self, receiver, assoc):
+		self.receiver = receiver
+		self.t_start = time.perf_counter()
+		self.isotime = datetime.now().isoformat()
+		self.staging = os.path.join(receiver.incoming, f"{time.time_ns()}-{threading.get_ident()}")
+		os.makedirs(self.staging)
+		self.studyinfo = {
+			'Local_AET': assoc.acceptor.ae_title.strip(),
+			'Remote_AET': assoc.requestor.ae_title.strip(),
+			'Remote_Host': assoc.requestor.address,
+		}
+		self.rulesets = [rs.clone() for rs in receiver.load_rulesets()]
+		self.tags = None if receiver.all_tags else collect_tags(self.rulesets)
+		if receiver.dedup is not None and self.tags is not None:
+			self.tags = sorted(set(self.tags) | {SOP_INSTANCE_UID})
+		self.instances = {} # staged source -> (SOPInstanceUID, digest)
+		self.files = 0
+		self.dicom_files = 0
+		self.duplicates = 0
+		self.timings = {'receive': 0.0, 'parse': 0.0, 'dedup': 0.0, 'write': 0.0}
+
+	def store(self, event):
+		t0 = time.perf_counter()
+		data = encode_file(event)
+		path = os.path.join(self.staging, f"{event.request.AffectedSOPInstanceUID}.dcm")
+		metadata = file_metadata(path, self.studyinfo, self.isotime)
+		t1 = time.perf_counter()
+		try:
+			metadata['dicom'], metadata['pixeldata'] = parse_header(io.BytesIO(data), self.tags)
+			metadata['isDicom'] = True
+			if self.receiver.dedup_hash:
+				metadata['digest'] = hashlib.sha1(data).hexdigest()
+		except Exception:
+			metadata['isDicom'] = False
+			metadata['dicom'] = {}
+		t2 = time.perf_counter()
+		self.timings['parse'] += t2 - t1
+		self.files += 1
+		self.dicom_files += metadata['isDicom']
+
+		# instances sorted before are not written again
+		uid = sorted_path = None
+		if self.receiver.dedup is not None:
+			uid, sorted_path = find_duplicate(self.receiver.dedup, metadata)
+		t3 = time.perf_counter()
+		self.timings['dedup'] += t3 - t2
+		if sorted_path is not None:
+			self.duplicates += 1
+			metadata['duplicate'] = sorted_path
+		else:
+			with open(path, 'wb') as fp:
+				fp.write(data)
+			self.timings['write'] += time.perf_counter() - t3
+		if uid is not None:
+			self.instances[sorted_path or path] = (uid, metadata.get('digest'))
+		if sorted_path is None or self.receiver.dedup_mode != 'skip':
+			for ruleset in self.rulesets:
+				ruleset.testFile(metadata)
+		self.timings['receive'] += time.perf_counter() - t0
+
+	def commit(self):
+		# test requirements and move the matched files in place
+		path = os.path.join(self.staging, 'studyinfo.json')
+		with open(path, 'w') as fp:
+			json.dump(self.studyinfo, fp, indent=3)
+		metadata = file_metadata(path, self.studyinfo, self.isotime)
+		metadata['isDicom'] = False
+		metadata['dicom'] = {}
+		self.files += 1
+		for ruleset in self.rulesets:
+			ruleset.testFile(metadata)
+		print(f"Received {self.files} files from {self.studyinfo['Remote_AET']} ({self.studyinfo['Remote_Host']})")
+		if self.duplicates:
+			print(f"{self.duplicates} instances have been sorted before ({self.receiver.dedup_mode})")
+		plan = {
+			'searchpath': self.staging,
+			'data_out': self.receiver.data_out,
+			'isotime': self.isotime,
+			'files': self.files,
+			'dicom_files': self.dicom_files,
+			'duplicates': self.duplicates,
+			'dry_run': False,
+			'timings': self.timings,
+			'rulesets': finish_rulesets(self.rulesets, self.receiver.data_out, dedup=self.receiver.dedup, instances=self.instances),
+		}
+		self.timings['total'] = time.perf_counter() - self.t_start
+		self.cleanup()
+		return plan
+
+	def cleanup(self):
+		# files left over did not match, or their requirements were not met.
+		# they are kept in scratch, as storescp would have left them
+		left = os.listdir(self.staging)
+		if not left:
+			os.rmdir(self.staging)
+			return
+		dest = os.path.join(self.receiver.scratch, os.path.basename(self.staging))
+		shutil.move(self.staging, dest)
+		print(f"Kept {len(left)} unsorted files in {dest}")
+
+# storage SCP replacing storescp and sort.sh, see Study
+class Receiver:
+	def __init__(self, aet, port, data_out, scratch, all_tags=False, metrics=None, prom=None, dedup='off', dedup_db=None, dedup_hash=False, max_pdu=131072):
+		self.aet = aet
+		self.port = port
+		self.data_out = data_out
+		self.scratch = scratch
+		self.incoming = os.path.join(data_out, '.incoming') # on the same filesystem as data_out
+		self.all_tags = all_tags
+		self.metrics = metrics
+		self.prom = prom
+		self.dedup = open_dedup(dedup, data_out, dedup_db)
+		self.dedup_mode = dedup
+		self.dedup_hash = dedup_hash and self.dedup is not None
+		self.studies = {} # association -> Study
+		self.lock = threading.Lock()
+		self.cache_lock = threading.Lock()
+		self.cache = RuleSetCache(rulesdir)
+		check_dedup_mode(dedup, self.cache.load())
+		os.makedirs(self.incoming, exist_ok=True)
+		os.makedirs(scratch, exist_ok=True)
+		self.recover()
+
+		register_csa()
+		self.ae = AE(aet)
+		self.ae.maximum_pdu_size = max_pdu
+		# accept any transfer syntax, like storescp +xa
+		for cx in AllStoragePresentationContexts:
+			self.ae.add_supported_context(cx.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+		self.ae.add_supported_context(CSA_NON_IMAGE_STORAGE, ALL_TRANSFER_SYNTAXES)
+		for cx in VerificationPresentationContexts:
+			self.ae.add_supported_context(cx.abstract_syntax)
+
+	def load_rulesets(self):
+		# pick up edited rulesets, only changed files are recompiled
+		with self.cache_lock:
+			return self.cache.load()
+
+	def recover(self):
+		# studies left in staging by a restart were never committed
+		for d in os.listdir(self.incoming):
+			print(f"Moving interrupted study {d} to {self.scratch}")
+			shutil.move(os.path.join(self.incoming, d), os.path.join(self.scratch, d))
+
+	def handle_store(self, event):
+		try:
+			with self.lock:
+				study = self.studies.get(event.assoc)
+				if study is None:
+					study = self.studies[event.assoc] = Study(self, event.assoc)
+			study.store(event)
+		except Exception:
+			traceback.print_exc()
+			return 0xA700 # out of resources
+		return 0x0000
+
+	def handle_released(self, event):
+		with self.lock:
+			study = self.studies.pop(event.assoc, None)
+		if study is None:
+			return
+		try:
+			plan = study.commit()
+			export_metrics(plan, self.metrics, self.prom)
+		except Exception:
+			print(f"Sorting {study.staging} failed")
+			traceback.print_exc()
+
+	def handle_aborted(self, event):
+		# an aborted association is kept as it is, without sorting
+		with self.lock:
+			study = self.studies.pop(event.assoc, None)
+		if study is not None:
+			print(f"Association from {study.studyinfo['Remote_AET']} aborted")
+			study.cleanup()
+
+	def serve(self):
+		handlers = [
+			(evt.EVT_C_STORE, self.handle_store),
+			(evt.EVT_RELEASED, self.handle_released),
+			(evt.EVT_ABORTED, self.handle_aborted),
+		]
+		print(f"Receiving as {self.aet} on port {self.port}, sorting to '{self.data_out}'")
+		self.ae.start_server(('', self.port), evt_handlers=handlers)
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description='Receive DICOM files and sort them while they arrive')
+	parser.add_argument('data_out', help='root folder for sorted files')
+	parser.add_argument('--aet', default='NMPROC', help='AE title to accept associations for')
+	parser.add_argument('--port', type=int, default=11112)
+	parser.add_argument('--scratch', default='/scratch', help='folder for files that were not sorted')
+	parser.add_argument('--all-tags', action='store_true', help='read complete headers instead of only the tags used by the rulesets')
+	parser.add_argument('--metrics', metavar='FILE', help='append phase timings and match counts as a json line per association')
+	parser.add_argument('--prom', metavar='FILE', help='write phase timings and match counts of the last association in prometheus text format')
+	add_dedup_args(parser)
+	return parser.parse_args(argv)
+
+def main():
+	args = parse_args()
+	receiver = Receiver(args.aet, args.port, args.data_out, args.scratch, args.all_tags, args.metrics, args.prom, args.dedup, args.dedup_db, args.dedup_hash)
+	receiver.serve()
+
+if __name__ == '__main__':
+	main()
@@ -1,47 +1,219 @@
 import os
 import re
+import copy
 import json
+import time
+import hashlib
 import pydicom
-from helpers import actions, operators
+from helpers import batch_actions, write_series_index, read_header, operators
 
 _alphanumeric = re.compile('[^\w/._\-]')
+link_actions = {'mv', 'cp', 'ln'} # actions replaced by a link for duplicates
 
 class RuleSet:
-	def __init__(self, rulefile):
+	def __init__(self, rulefile, compiled=True):
 		with open(rulefile,'r') as fp:
 			rules = json.load(fp)
 			self.rules = []
+			self.staged = []
+			self.consumed = {} # staged index -> source removed after the action
+			self.reindex = {} # staged index -> digest of a linked file, indexed in doActions
+			self.timings = {'test': 0.0, 'format': 0.0}
 			self.name = os.path.basename(rulefile)
 			for params in rules:
 				self.rules.append(Rule(**params))
-				
-	def testFile(self,fileinfo):
-		fileinfo['success'] = False
-		for rule in self.rules:
-			success = rule.testFile(fileinfo)
-			if success:
-				fileinfo['newpath'] = rule.getNewPath(fileinfo)
-				fileinfo['action'] = rule.action
-				fileinfo['success'] = True
-				break
-		# sort list with latest matches on top to speed up sorting
-		return None # or filepath
+		# dicom tags needed to test files and format destinations
+		self.tags = set().union(*[r.tags for r in self.rules])
+		self.compile(compiled)
+
+	def clone(self):
+		# copy with its own match counts and staged actions, sharing the
+		# compiled rules, so several folders can be sorted at once
+		ruleset = copy.copy(self)
+		ruleset.rules = [copy.copy(r) for r in self.rules]
+		for r in ruleset.rules:
+			r.n = 0
+		ruleset.staged = []
+		ruleset.consumed = {}
+		ruleset.reindex = {}
+		ruleset.timings = {'test': 0.0, 'format': 0.0}
+		return ruleset
+
+	def compile(self, compiled=True):
+		# index rules by the value of a literal regex test (e.g.
+		# ^Head_MRAC_UTE$), so each file is only tested against the rules
+		# that can possibly match it. rules without such a test are always
+		# candidates.
+		self.index = {}
+		self.unindexed = []
+		for i, rule in enumerate(self.rules):
+			vt = next((vt for vt in rule.tests if vt.literal is not None), None) if compiled else None
+			if vt is None:
+				self.unindexed.append(i)
+			else:
+				getValue, table = self.index.setdefault(vt.key, (vt.getValue, {}))
+				table.setdefault(vt.literal, []).append(i)
+
+	def candidates(self, metadata):
+		found = list(self.unindexed)
+		for getValue, table in self.index.values():
+			try:
+				value = getValue(metadata)
+			except Exception:
+				value = None
+			if isinstance(value, str):
+				found += table.get(value, [])
+				if value.endswith('\n'): # regex $ also matches before a trailing newline
+					found += table.get(value[:-1], [])
+			else:
+				# not a string, let the rules themselves decide (or raise)
+				for rules in table.values():
+					found += rules
+		return sorted(set(found))
+
+	def testFile(self,metadata):
+		# stage the first matching rule as a compact (source, destination,
+		# action, index entry) record, so the metadata can be dropped after
+		# testing.
+		# candidates are tested in rule order, so the first match is the
+		# same as when testing every rule.
+		t0 = time.perf_counter()
+		for i in self.candidates(metadata):
+			rule = self.rules[i]
+			if rule.testFile(metadata):
+				t1 = time.perf_counter()
+				newpath = rule.getNewPath(metadata)
+				src, action = metadata['fileinfo']['abspath'], rule.action
+				if metadata.get('duplicate') and action in link_actions:
+					# already sorted once, link to that copy instead. a file
+					# that would have been moved is still removed
+					if action == 'mv':
+						self.consumed[len(self.staged)] = src
+					src, action = metadata['duplicate'], 'hl'
+				# the index describes the file that ends up at newpath, a
+				# linked copy is read again in doActions
+				entry = None
+				if rule.index and action == 'hl':
+					self.reindex[len(self.staged)] = metadata.get('digest')
+					entry = {}
+				elif rule.index:
+					entry = Rule.getIndexEntry(metadata['dicom'], metadata.get('pixeldata'), metadata.get('digest')) if metadata['isDicom'] else {}
+				self.staged.append((src, newpath, action, entry))
+				self.timings['test'] += t1 - t0
+				self.timings['format'] += time.perf_counter() - t1
+				return True
+		self.timings['test'] += time.perf_counter() - t0
+		return False
+
+	def findRule(self, metadata):
+		# first rule matching the file, without counting or staging it
+		for i in self.candidates(metadata):
+			if self.rules[i].matches(metadata):
+				return self.rules[i]
+		return None
 
 	def testRequirements(self):
 		print(f"({self.name})")
 		return all([r.testRequirement() for r in self.rules])
 
-	def doAction(self, metadata, rootpath):
-		if not metadata['success']:
-			return
-		abspath = metadata['fileinfo']['abspath']
-		newpath = os.path.join(rootpath,metadata['newpath'])
-		#if os.path.lexists(newpath):
-		#	os.remove(newpath)
-		actions[metadata['action']](abspath, newpath)
+	def doActions(self, rootpath, workers=4):
+		items = [(abspath, os.path.join(rootpath,newpath), action) for abspath, newpath, action, entry in self.staged]
+		# studyinfo.json is done after the series indexes are written, so
+		# the apps never see a study without its indexes
+		last = [i for i, (abspath, _, _) in enumerate(items) if os.path.basename(abspath) == 'studyinfo.json']
+		first = [i for i in range(len(items)) if i not in last]
+		results = [None]*len(items)
+		for i, digest in self.reindex.items():
+			self.staged[i][3].update(Rule.readIndexEntry(self.staged[i][0], digest))
+		for i, result in zip(first, batch_actions([items[i] for i in first], workers)):
+			results[i] = result
+		write_series_index([dict(path=results[i][1], **self.staged[i][3]) for i in first if results[i][2] is None and self.staged[i][3] is not None])
+		for i, result in zip(last, batch_actions([items[i] for i in last], workers)):
+			results[i] = result
+		# sources of moves replaced by links, see testFile. the receiver
+		# does not write them at all
+		for i, path in self.consumed.items():
+			if results[i][2] is None and os.path.exists(path):
+				try:
+					os.remove(path)
+				except OSError as e:
+					print(f"\tCould not remove {path}: {e}")
+		failed = [(src, dest, e) for src, dest, e in results if e is not None]
+		for src, dest, e in failed:
+			print(f"\tFailed {src} -> {dest}: {e}")
+		print(f"\t{len(results)-len(failed)} files done, {len(failed)} failed")
+		return results
+
+	def plan(self, rootpath, results=None):
+		# machine readable summary of rule matches and staged actions
+		if results is None:
+			results = [(abspath, newpath, None) for abspath, newpath, action, entry in self.staged]
+		return {
+			'name': self.name,
+			'requirements': all(r.requirementMet() for r in self.rules),
+			'rules': [{
+				'name': r.name,
+				'action': r.action,
+				'requirement': ''.join(['n', *r.requirement[0]]) if r.requirement else None,
+				'n': r.n,
+				'passed': r.requirementMet(),
+			} for r in self.rules],
+			'actions': [{
+				'src': abspath,
+				'dest': os.path.join(rootpath,newpath),
+				'action': action,
+				'error': None if e is None else str(e),
+			} for (abspath, newpath, action, entry), (_, _, e) in zip(self.staged, results)],
+		}
 
 
 
+class RuleSetCache:
+	# compiled rulesets of a folder, reloaded only when a file changes
+	def __init__(self, rulesdir, compiled=True):
+		self.rulesdir = rulesdir
+		self.compiled = compiled
+		self.entries = {} # filename -> (stat key, content hash, RuleSet)
+
+	def load(self):
+		rulesets = []
+		found = set()
+		for f in os.listdir(self.rulesdir):
+			if not f.endswith('.json'):
+				continue
+			found.add(f)
+			rulefile = os.path.join(self.rulesdir,f)
+			st = os.stat(rulefile)
+			key = (st.st_mtime_ns, st.st_size)
+			entry = self.entries.get(f)
+			if entry is None or entry[0] != key:
+				try:
+					entry = self.reload(f, rulefile, key, entry)
+				except Exception as e:
+					# keep using the last good version of a broken ruleset
+					print(f"{f}: failed to load ({e})")
+					if entry is None:
+						continue
+			rulesets.append(entry[2])
+		for f in set(self.entries) - found:
+			print(f"{f}: removed")
+			del self.entries[f]
+		return rulesets
+
+	def reload(self, f, rulefile, key, entry):
+		t0 = time.perf_counter()
+		with open(rulefile,'rb') as fp:
+			digest = hashlib.sha1(fp.read()).hexdigest()
+		# touched but unchanged, keep the compiled ruleset
+		if entry is not None and entry[1] == digest:
+			entry = (key, digest, entry[2])
+		else:
+			ruleset = RuleSet(rulefile, self.compiled)
+			entry = (key, digest, ruleset)
+			print(f"{f}: loaded {len(ruleset.rules)} rules in {(time.perf_counter()-t0)*1000:.1f} ms")
+		self.entries[f] = entry
+		return entry
+
 class Rule:
 	# static regex parsers
 	regex_placeholder = r'(?:(?:\{)(\w+)(?:\:\w+)?(?:\}))'
@@ -49,28 +221,49 @@ class Rule:
 	re_placeholder = re.compile(regex_placeholder)
 	re_requirement = re.compile(regex_requirement)
 
-	def __init__(self, name='default', destination='{name}/{filename}{ext}', action='move', tests=None, requirement=""):
+	# header values kept in the series index, see getIndexEntry. they are
+	# read with the tags of the tests by rules with an index, together with
+	# the offset of the pixel data
+	index_keywords = ['SOPInstanceUID', 'InstanceNumber', 'Rows', 'Columns', 'SamplesPerPixel', 'BitsAllocated', 'PixelRepresentation']
+	index_tags = [pydicom.tag.Tag(kw) for kw in index_keywords + ['PixelData']]
+
+	def __init__(self, name='default', destination='{name}/{filename}{ext}', action='move', tests=None, requirement="", index=False):
 		self.n = 0
+		self.index = index
 		self.name = name
 		self.destination = destination
 		self.action = action
 		self.requirement = Rule.re_requirement.findall(requirement)
 		self.tests = [ValueTest(t) for t in tests]
 		self.placeholders = Rule.re_placeholder.findall(destination)
+		self.tags = set().union(*[vt.tags for vt in self.tests])
+		if index:
+			self.tags.update(Rule.index_tags)
+		for ph in self.placeholders:
+			tag = pydicom.datadict.tag_for_keyword(ph)
+			if tag is not None:
+				self.tags.add(tag)
 
-	def testRequirement(self):
+	def requirementMet(self):
 		if len(self.requirement) == 0:
-			print(f"({self.name}) n: {self.n} (True)")
 			return True
 		op_, val_ = self.requirement[0]
-		op = operators[op_]
-		val = int(val_)
-		res = op(self.n, val)
-		print(f"\t({self.name}) n: {self.n} {op_} {val} ({res})")
+		return operators[op_](self.n, int(val_))
+
+	def testRequirement(self):
+		res = self.requirementMet()
+		if len(self.requirement) == 0:
+			print(f"({self.name}) n: {self.n} ({res})")
+		else:
+			op_, val_ = self.requirement[0]
+			print(f"\t({self.name}) n: {self.n} {op_} {int(val_)} ({res})")
 		return res
 
+	def matches(self,fileinfo):
+		return all([vt.test(fileinfo) for vt in self.tests])
+
 	def testFile(self,fileinfo):
-		success = all([vt.test(fileinfo) for vt in self.tests])
+		success = self.matches(fileinfo)
 		self.n += success
 		return success
 	
@@ -88,26 +281,63 @@ class Rule:
 				values[ph] = 'None'
 		return self.destination.format(**values)
 
+	@staticmethod
+	def getIndexEntry(ds, pixeldata, digest=None):
+		# where the pixel data of an uncompressed little endian file can
+		# be memory mapped from, given its header and the (offset, length)
+		# of its pixel data. the path is added by doActions
+		entry = {}
+		for kw in Rule.index_keywords:
+			value = ds.get(kw)
+			entry[kw] = None if value is None else (str(value) if kw == 'SOPInstanceUID' else int(value))
+		ts = ds.file_meta.get('TransferSyntaxUID') if hasattr(ds, 'file_meta') else None
+		entry['TransferSyntaxUID'] = None if ts is None else str(ts)
+		entry['offset'] = None
+		if digest:
+			entry['digest'] = digest
+		if pixeldata and ts is not None and ts.is_little_endian and not ts.is_compressed and not ts.is_deflated and entry['BitsAllocated'] in (8, 16, 32):
+			kind = 'i' if entry['PixelRepresentation'] else 'u'
+			entry['dtype'] = f"<{kind}{entry['BitsAllocated']//8}"
+			entry['shape'] = [entry['Rows'], entry['Columns']] + ([entry['SamplesPerPixel']] if entry['SamplesPerPixel'] not in (None, 1) else [])
+			entry['offset'], entry['length'] = pixeldata
+		return entry
+
+	@staticmethod
+	def readIndexEntry(path, digest=None):
+		try:
+			return Rule.getIndexEntry(*read_header(path, Rule.index_tags), digest)
+		except Exception:
+			return {}
+
 class ValueTest:
 	# static regex parsers
 	regex_descriptor = r"(\w+)\(([\w,]+)\):(\w+)\((.*)\)$"
 	desc_parser = re.compile(regex_descriptor)
 	regex_math = r'^(<|>|<=|>=|=)((?:[0-9]+)(?:.[0-9]*)?)$'
 	math_parser = re.compile(regex_math)
+	regex_literal = r'^\^?([^\\.^$*+?{}\[\]|()]*)\$$'
+	literal_parser = re.compile(regex_literal)
 
 	def __init__(self, descriptor):
+		self.tags = set()
+		self.key = descriptor
+		self.literal = None # value matched exactly by a regex test, if any
 		match = ValueTest.desc_parser.match(descriptor)
 		if match == None:
 			print('Format error: %s'%descriptor)
 			# throw exceptioncp /
 		else:
 			fieldtype, fieldname, testtype, testvalue = match.groups()
+			self.key = (fieldtype, fieldname)
 	
 			if fieldtype == 'dicom':
 				if ',' in fieldname:
 					self.tag = int(fieldname.replace('0x','').replace(',',''),base=16)
 				else:
 					self.tag = pydicom.datadict.tag_for_keyword(fieldname)
+				if self.tag is not None:
+					self.tags.add(self.tag)
+				self.key = (fieldtype, self.tag)
 				self.getValue = self.getDicomValue
 			elif fieldtype == 'fileinfo':
 				self.getValue = lambda metadata: metadata['fileinfo'][fieldname]
@@ -118,6 +348,9 @@ class ValueTest:
 				self.test = lambda metadata: self.getValue(metadata) == True
 			elif testtype == 'regex':
 				re_test = re.compile(testvalue)
+				literal = ValueTest.literal_parser.match(testvalue)
+				if literal:
+					self.literal = literal.group(1)
 				self.test = lambda metadata: re_test.match(self.getValue(metadata)) != None
 			elif testtype == 'math':
 				op, val = ValueTest.math_parser.match(testvalue).groups()
@@ -3,4 +3,13 @@ SCRATCH="/scratch"
 SCRIPT="/app/sort.sh #a #c '#r' #p"
 PORT="11112"
 RCV_AET="NMPROC"
+DATA="/data"
+
+# RECEIVER=python sorts files while they are received, instead of storescp
+# writing them to scratch and running sort.sh at the end of each association
+if [ "${RECEIVER}" = "python" ]; then
+   exec python3 /app/receiver.py --aet ${RCV_AET} --port ${PORT} --scratch ${SCRATCH} --dedup link --metrics /var/log/nmproc-metrics.jsonl --prom /var/log/nmproc.prom ${DATA}
+fi
+
+python3 /app/sorterd.py --jobs 2 -j 4 --dedup link --metrics /var/log/nmproc-metrics.jsonl --prom /var/log/nmproc.prom &
 storescp -v -pm -sp -pdu 131072 +xa -aet ${RCV_AET} -tos 3 -od "${SCRATCH}" -xcs "${SCRIPT}" ${PORT}
\ No newline at end of file
@@ -6,6 +6,10 @@ FOLDER=$4
 DATA="/data"
 JSON_FILE="${FOLDER}/studyinfo.json"
 LOG_FILE="/var/log/nmproc.log"
+METRICS_FILE="/var/log/nmproc-metrics.jsonl"
+PROM_FILE="/var/log/nmproc.prom"
+SPOOL="/var/spool/nmproc"
+PID_FILE="/run/nmproc-sorterd.pid"
 
 echo "{" > $JSON_FILE
 echo "   \"Local_AET\":   \"${LOCAL_AET}\"," >> $JSON_FILE
@@ -13,8 +17,14 @@ echo "   \"Remote_AET\":  \"${REMOTE_AET}\"," >> $JSON_FILE
 echo "   \"Remote_Host\": \"${REMOTE_IP}\"" >> $JSON_FILE
 echo "}" >> $JSON_FILE
 
-# sort files
-python3 /app/dicom_sorter.py ${FOLDER} ${DATA}
+# sort files, queue job for the sorter daemon if it is running
+if kill -0 $(cat ${PID_FILE} 2>/dev/null) 2>/dev/null; then
+   JOB="${SPOOL}/$(date +%s%N)-$$.json"
+   echo "{\"searchpath\": \"${FOLDER}\", \"data_out\": \"${DATA}\"}" > "${JOB}.tmp"
+   mv "${JOB}.tmp" "${JOB}"
+else
+   python3 /app/dicom_sorter.py -j 4 --dedup link --metrics ${METRICS_FILE} --prom ${PROM_FILE} ${FOLDER} ${DATA}
+fi
 
 # cleanup
 #rm -rf ${FOLDER}
\ No newline at end of file
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import signal
+import argparse
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dicom_sorter import rulesdir, check_dedup_mode, collect_tags, sort_folder, add_dedup_args, open_dedup
+from rules import RuleSetCache
+from metrics import export_metrics
+
+# jobs are small json files dropped in the spool folder by sort.sh:
+#   <name>.json       waiting job
+#   <name>.json.work  job being sorted, put back in the queue on restart
+#   *.tmp             job still being written, ignored
+JOB_EXT = '.json'
+WORK_EXT = '.work'
+
+def submit_job(spool, searchpath, data_out):
+	name = os.path.join(spool, f"{time.time_ns()}-{os.getpid()}{JOB_EXT}")
+	with open(name + '.tmp', 'w') as fp:
+		json.dump({'searchpath': searchpath, 'data_out': data_out}, fp)
+	os.rename(name + '.tmp', name)
+	return name
+
+def recover_jobs(spool):
+	for f in os.listdir(spool):
+		if f.endswith(JOB_EXT + WORK_EXT):
+			print(f"Requeuing interrupted job {f}")
+			os.rename(os.path.join(spool, f), os.path.join(spool, f[:-len(WORK_EXT)]))
+
+def waiting_jobs(spool):
+	return sorted(f for f in os.listdir(spool) if f.endswith(JOB_EXT))
+
+class Sorter:
+	def __init__(self, spool, jobs=2, workers=4, pool='thread', all_tags=False, metrics=None, prom=None, dedup='off', dedup_db=None, dedup_hash=False):
+		self.spool = spool
+		self.jobs = jobs
+		self.workers = workers
+		self.pool = pool
+		self.all_tags = all_tags
+		self.metrics = metrics
+		self.prom = prom
+		self.dedup = dedup
+		self.dedup_db = dedup_db
+		self.dedup_hash = dedup_hash
+		self.dedups = {} # data_out -> DedupIndex, opened on first use
+		self.lock = threading.Lock()
+		self.running = set()
+		self.stopping = False
+		self.cache = RuleSetCache(rulesdir)
+		check_dedup_mode(dedup, self.cache.load())
+
+	def dedup_index(self, data_out):
+		with self.lock:
+			if data_out not in self.dedups:
+				self.dedups[data_out] = open_dedup(self.dedup, data_out, self.dedup_db)
+			return self.dedups[data_out]
+
+	def run_job(self, workfile, rulesets):
+		try:
+			with open(workfile) as fp:
+				job = json.load(fp)
+			t0 = time.perf_counter()
+			print(f"Sorting {job['searchpath']} -> {job['data_out']}")
+			tags = None if self.all_tags else collect_tags(rulesets)
+			dedup = self.dedup_index(job['data_out'])
+			plan = sort_folder(job['searchpath'], job['data_out'], rulesets, self.workers, self.pool, tags, progress=False, dedup=dedup, dedup_mode=self.dedup, digest=self.dedup_hash)
+			print(f"Sorted {job['searchpath']} in {time.perf_counter()-t0:.1f} s")
+			export_metrics(plan, self.metrics, self.prom)
+		except Exception:
+			print(f"Sorting job {workfile} failed")
+			traceback.print_exc()
+		finally:
+			os.remove(workfile)
+			self.running.discard(workfile)
+
+	def claim(self, executor):
+		# only claim as many jobs as can run, the rest stay in the spool
+		jobs = waiting_jobs(self.spool)
+		if jobs and len(self.running) < self.jobs:
+			# pick up edited rulesets, only changed files are recompiled
+			rulesets = self.cache.load()
+		for f in jobs:
+			if len(self.running) >= self.jobs:
+				break
+			jobfile = os.path.join(self.spool, f)
+			workfile = jobfile + WORK_EXT
+			os.rename(jobfile, workfile)
+			self.running.add(workfile)
+			executor.submit(self.run_job, workfile, rulesets)
+
+	def stop(self, *args):
+		self.stopping = True
+
+	def serve(self, poll=0.2):
+		recover_jobs(self.spool)
+		print(f"Waiting for jobs in '{self.spool}' ({self.jobs} concurrent)")
+		with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+			while not self.stopping:
+				self.claim(executor)
+				time.sleep(poll)
+		print("Stopped, waiting for running jobs")
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description='Resident DICOM sorter taking jobs from a spool folder')
+	parser.add_argument('--spool', default='/var/spool/nmproc', help='folder where sort.sh drops jobs')
+	parser.add_argument('--pidfile', default='/run/nmproc-sorterd.pid')
+	parser.add_argument('--jobs', type=int, default=2, help='number of folders sorted at once')
+	parser.add_argument('-j', '--workers', type=int, default=4, help='number of concurrent header readers per job')
+	parser.add_argument('--pool', choices=['thread','process'], default='thread', help='type of worker pool used when workers > 1')
+	parser.add_argument('--all-tags', action='store_true', help='read complete headers instead of only the tags used by the rulesets')
+	parser.add_argument('--metrics', metavar='FILE', help='append phase timings and match counts as a json line per job')
+	parser.add_argument('--prom', metavar='FILE', help='write phase timings and match counts of the last job in prometheus text format')
+	parser.add_argument('--submit', nargs=2, metavar=('SEARCHPATH', 'DATA_OUT'), help='queue a job and exit')
+	add_dedup_args(parser)
+	return parser.parse_args(argv)
+
+def main():
+	args = parse_args()
+	os.makedirs(args.spool, exist_ok=True)
+	if args.submit:
+		print(submit_job(args.spool, *args.submit))
+		return
+
+	sorter = Sorter(args.spool, args.jobs, args.workers, args.pool, args.all_tags, args.metrics, args.prom, args.dedup, args.dedup_db, args.dedup_hash)
+	signal.signal(signal.SIGTERM, sorter.stop)
+	signal.signal(signal.SIGINT, sorter.stop)
+	with open(args.pidfile, 'w') as fp:
+		fp.write(f"{os.getpid()}\n")
+	try:
+		sorter.serve()
+	finally:
+		os.remove(args.pidfile)
+
+if __name__ == '__main__':
+	main()
@@ -1,8 +1,9 @@
 #!/usr/bin/python3
 import os
 import json
-from xnuccalc import process_fids
-from pynetdicom import AE
+from xnuccalc import process_fids, warmup
+from dicom_sender import DicomSender
+from scheduler import JobScheduler
 from inotify.adapters import Inotify
 from inotify.constants import IN_CREATE, IN_ISDIR
 
@@ -10,57 +11,56 @@ monitor = "/data"
 json_file = "studyinfo.json"
 local_aet="NMPROC"
 ip_adr="10.85.77.52"
+remote_port=104
+retry_dir = "/data/.retry" # results that could not be sent are queued here
+failed_dir = "/data/.failed" # results rejected by the remote are kept here
+queue_file = "/data/.xnuccalc_jobs.json" # studies not yet processed
+processed_file = "/data/.xnuccalc_processed.json" # inputs of processed studies
+first_run_file = "/data/.xnuccalc_first_run.json" # studies from before it are not recovered
+job_workers = 2
+job_timeout = 600 # seconds
 
-def send_dicom(dcm, remote_host, remote_port, remote_aet, local_aet):
-   # setup application entry
-   ae = AE(local_aet)
-   ae.add_requested_context(dcm.SOPClassUID, dcm.file_meta.TransferSyntaxUID)
-   # Associated with peer
-   assoc = ae.associate(remote_host, remote_port, ae_title=remote_aet)
+sender = DicomSender(local_aet, retry_dir=retry_dir, failed_dir=failed_dir)
 
-   if assoc.is_established:
-      status = assoc.send_c_store(dcm)
-      # Check the status of the storage request
-      if status:
-         # If the storage request succeeded this will be 0x0000
-         print(f"Sent succesfully to {remote_host}:{remote_port} ({remote_aet})")
-      else:
-         print('Connection timed out, was aborted or received invalid response')
-         print('C-STORE request status: 0x{0:04x}'.format(status.Status))
-   else:
-      print(f"Could not connect to {remote_host}:{remote_port}")
-   assoc.release()
-
-def process_folder(path):
-   # if file found, to stuff
+def send_results(path, dcms):
+   # called with the result of process_fids once the job has finished
 	#read json
    with open(os.path.join(path,json_file)) as file:
       studyinfo = json.load(file)
 
-   dcms = process_fids(path)
-   if dcms:
-      #send_dicom(dcm, studyinfo['Remote_Host'], 104, studyinfo['Remote_AET'], local_aet)
-      for dcm in dcms:
-         send_dicom(dcm, ip_adr, 104, studyinfo['Remote_AET'], local_aet)
-   else:
-      print(f"Processing of {path} failed")
+   if not dcms:
+      raise RuntimeError(f"Processing of {path} failed")
+   #sender.send(dcms, studyinfo['Remote_Host'], 104, studyinfo['Remote_AET'])
+   sender.send(dcms, ip_adr, remote_port, studyinfo['Remote_AET'])
 
 # start monitoring data folder
-i = Inotify()
-i.add_watch(monitor, IN_CREATE)
-print(f"Monitoring '{monitor}'")
-for event in i.event_gen(yield_nones=False):
-   (id, type_names, path, filename) = event
-   
-   # if new folder, watch for json file.
-   if 'IN_ISDIR' in type_names:
-      new_path = os.path.join(path, filename)
-      print(f"Watching {new_path}")
-      # check if file already exist, if so start processing job
-      if os.path.isfile(os.path.join(new_path, json_file)):
-         process_folder(new_path)
-      else:
-         i.add_watch(new_path, IN_CREATE)
-   elif filename == json_file:
-      i.remove_watch(path)
-      process_folder(path)
+if __name__ == "__main__":
+   warmup()
+   jobs = JobScheduler(process_fids, send_results, workers=job_workers, timeout=job_timeout, queue_file=queue_file, processed_file=processed_file, first_run_file=first_run_file)
+   i = Inotify()
+   i.add_watch(monitor, IN_CREATE)
+   print(f"Monitoring '{monitor}'")
+   sender.retry()
+   jobs.restore()
+   jobs.recover(monitor, json_file, watch=lambda path: i.add_watch(path, IN_CREATE))
+   for event in i.event_gen(yield_nones=True):
+      if event is None:
+         # between events, retry queued sends once per retry_interval
+         sender.retry()
+         continue
+      (id, type_names, path, filename) = event
+      
+      # if new folder, watch for json file.
+      if 'IN_ISDIR' in type_names:
+         if filename.startswith('.'):
+            continue # retry queue and other hidden folders
+         new_path = os.path.join(path, filename)
+         print(f"Watching {new_path}")
+         # check if file already exist, if so start processing job
+         if os.path.isfile(os.path.join(new_path, json_file)):
+            jobs.submit(new_path)
+         else:
+            i.add_watch(new_path, IN_CREATE)
+      elif filename == json_file:
+         i.remove_watch(path)
+         jobs.submit(path)
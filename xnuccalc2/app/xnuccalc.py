@@ -2,14 +2,26 @@
 import pydicom
 import os
 import sys
+import copy
+import time
+import importlib
 import numpy as np
-import lmfit
-import matplotlib.pyplot as plt
 from datetime import datetime
-from nibabel.nicom import csareader
+from concurrent.futures import ThreadPoolExecutor
+
+CSA_GROUP_END = pydicom.tag.Tag(0x0029, 0xFFFF) # last tag of the siemens CSA private group
+FID_DATA = pydicom.tag.Tag(0x7fe1, 0x1010) # siemens spectroscopy data
+
+fit_backend = 'scipy' # or 'lmfit', the original fit kept for validation
 
 # calculate optimal Vref
-def find_vref(voltages, amplitudes, noise=False):
+def find_vref(voltages, amplitudes, noise=False, backend=None):
+    if (backend or fit_backend) == 'lmfit':
+        return find_vref_lmfit(voltages, amplitudes, noise)
+    return find_vref_scipy(voltages, amplitudes, noise)
+
+def find_vref_lmfit(voltages, amplitudes, noise=False):
+    import lmfit # slow to import, only loaded when used
     model_sin = lmfit.models.SineModel() # sine fit
     model_nf  = lmfit.models.ConstantModel() # noise floor
     model = model_sin
@@ -37,38 +49,98 @@ def find_vref(voltages, amplitudes, noise=False):
     fit_pi = result.eval_uncertainty(sigma=2, x=fit_v)
     return vref, vref_u, fit_v, fit_a, fit_pi
 
+# amplitude*sin(frequency*x) (+ c), and its jacobian
+def sine(x, frequency, amplitude, c=0.0):
+    return amplitude*np.sin(frequency*x) + c
+
+def sine_jac(x, frequency, amplitude, c=None):
+    jac = [amplitude*x*np.cos(frequency*x), np.sin(frequency*x)]
+    if c is not None:
+        jac.append(np.ones_like(x))
+    return np.stack(jac, axis=-1)
+
+# closed form starting estimate. for a fixed frequency the model is linear in
+# amplitude and c, so solve the weighted linear least squares for a grid of
+# frequencies at once and keep the best
+def sine_guess(x, y, weight, noise=False, n=256):
+    vref = np.geomspace(np.max(x)/8, np.max(x)*4, n)
+    frequency = np.pi/(vref*2)
+    basis = [np.sin(frequency[:,np.newaxis]*x)]
+    if noise:
+        basis.append(np.ones((n, x.shape[0])))
+    a = np.stack(basis, axis=-1)*weight[:,np.newaxis] # n, points, params
+    b = y*weight
+    ata = np.einsum('gpi,gpj->gij', a, a)
+    atb = np.einsum('gpi,p->gi', a, b)
+    coef = np.linalg.solve(ata + 1e-12*np.eye(ata.shape[-1]), atb[...,np.newaxis])[...,0]
+    resid = np.sum((np.einsum('gpi,gi->gp', a, coef) - b)**2, axis=1)
+    resid[coef[:,0] < 0] = np.inf # amplitude must be positive
+    best = np.argmin(resid)
+    return [frequency[best], *coef[best]]
+
+def find_vref_scipy(voltages, amplitudes, noise=False):
+    from scipy.optimize import curve_fit
+    from scipy.stats import t
+    from scipy.special import erf
+    x = np.asarray(voltages, dtype=float)
+    y = np.asarray(amplitudes, dtype=float)
+
+    # same weighting as the lmfit fit, residuals are scaled by weight
+    weight = np.sqrt(y)
+    p0 = sine_guess(x, y, weight, noise)
+    lower = [0, 0, -np.inf][:len(p0)]
+    popt, pcov = curve_fit(sine, x, y, p0=p0, sigma=1/weight, bounds=(lower, np.inf), jac=lambda x, *p: sine_jac(x, *p))
+    vref = np.pi/(popt[0]*2)
+    vref_u = 1
+    fit_v = np.linspace(0,np.ceil(vref/5)*10,100)
+    fit_a = sine(fit_v, *popt)
+
+    # 2 sigma confidence band of the fit, from the parameter covariance
+    jac = sine_jac(fit_v, *popt)
+    scale = t.ppf((erf(2/np.sqrt(2))+1)/2, len(x)-len(popt))
+    fit_pi = scale*np.sqrt(np.einsum('pi,ij,pj->p', jac, pcov, jac))
+    return vref, vref_u, fit_v, fit_a, fit_pi
+
 # do FFT
 def time2freq(time_data, linewidth):
+    return time2freq_stack([time_data], linewidth)[0]
+
+# do FFT of all FIDs at once, one spectrum per row
+def time2freq_stack(time_data, linewidth, size=16384):
     # lorentz filter, I think...
-    t=np.arange(len(time_data))/len(time_data)
     Rlb=1/0.02 # 5-ish Hz, line broadening, maybe
     # 5 hz: Rlb = 5*pi s^-1
-    # exp(-Rlb) * FID
-    time_data = time_data*np.exp(-t*Rlb)   
-    
-    # pad data
-    time_data = np.pad(time_data, (0,16384-time_data.shape[0]), constant_values=0)
+    # exp(-Rlb) * FID, padded with zeros
+    stack = np.zeros((len(time_data), size), dtype=np.complex128)
+    for i, fid in enumerate(time_data):
+        t = np.arange(len(fid))/len(fid)
+        stack[i,:len(fid)] = fid*np.exp(-t*Rlb)
 
     # do fft and center frequency
-    fft = np.fft.fft(time_data)
-    fft_f0 = np.fft.fftshift(fft)
-    
-    # phase correction
-    fft_center = int(fft.shape[0]/2)
+    fft = np.fft.fft(stack, axis=1)
+    fft_f0 = np.fft.fftshift(fft, axes=1)
+
+    # phase correction, sum(Re(exp(i*theta)*S_k)) over the center bins is
+    # Re(exp(i*theta)*sum(S_k)), so only the summed bins are rotated
+    fft_center = int(size/2)
+    center = np.sum(fft[:,fft_center-8:fft_center+8], axis=1)
     theta = np.linspace(-np.pi,np.pi,360)
-    amp = np.sum(np.real(np.exp(complex(0,1)*theta) * fft[fft_center-8:fft_center+8,np.newaxis]), axis=0)
-    phase= theta[np.argmax(amp)]
+    amp = np.real(np.exp(complex(0,1)*theta)[np.newaxis,:] * center[:,np.newaxis])
+    phase = theta[np.argmax(amp, axis=1)]
 
-    phase_cor = np.exp(complex(0,phase))*fft_f0
+    phase_cor = np.exp(complex(0,1)*phase)[:,np.newaxis]*fft_f0
     absorption = np.real(phase_cor)
-    dispersion = np.imag(phase_cor)
-    
+
     return absorption
 
 def plot_spectrum(fids,ax):
+    # spectra are cached on the fids by read_files
+    if any('freq_data' not in fid for fid in fids):
+        for fid, freq_data in zip(fids, time2freq_stack([fid['time_data'] for fid in fids],16)):
+            fid['freq_data'] = freq_data
     shift = []
     for i in range(len(fids)):
-        y = time2freq(fids[i]['time_data'],16)
+        y = fids[i]['freq_data']
         x = np.linspace(-fids[i]['bandwidth']/2,fids[i]['bandwidth']/2, y.shape[0])/fids[i]['frequency']*1e6*-2
         ax.plot(x, y, linewidth=1.0, label=f"{fids[i]['voltage']:.0f} V")
         shift.append(x[np.argmax(y)])
@@ -80,54 +152,95 @@ def plot_spectrum(fids,ax):
     ax.set_xlabel('ppm')
     ax.legend()
 
-# read dicom MRS files
-def read_files(data_in:str):
-    fids = []
-    metadata = None
-    for filename in os.listdir(data_in):
-        try:
-            dcm = pydicom.dcmread(os.path.join(data_in,filename))
-        except:
-            ##print(f"{filename} is not a dicom")
-            continue
-
-        # check if a fid sequence
-        fid = False
-        try:
-            csa_image = csareader.get_csa_header(dcm,'image')['tags']
-            sequence = csa_image['SequenceName']['items'][0]
-            if sequence != "*fid":
-                continue
-        except:
-            #print(f"{filename} is not a valid Siemens FID file")
-            continue
-
-        data = {'filename': filename}
-            
-        #csa_series = csareader.get_csa_header(dcm,'series')['tags']
-        tr = csa_image['RepetitionTime']['items'][0]
-        data['voltage'] = csa_image['TransmitterReferenceAmplitude']['items'][0]
-        data['frequency'] = csa_image['ImagingFrequency']['items'][0] * 1e6
-        data['coil'] = csa_image['TransmittingCoil']['items'][0]
-        data['nucleus'] = csa_image['ImagedNucleus']['items'][0]
-        data['flipangle'] = csa_image['FlipAngle']['items'][0]
-        data['bandwidth'] = csa_image['PixelBandwidth']['items'][0]
-        data['description'] = dcm['SeriesDescription'].value
-        data['description2'] = dcm['StudyDescription'].value
-        #if int(data['voltage']) == 75:
-        #    with open('csa_image.txt', 'w') as f:
-        #        f.write(json.dumps(csa_image,indent=3,default=lambda o: '<not serializable>'))
-       
-        # read data array and calculate signal amplitude
-        data['time_data'] = np.frombuffer(dcm[0x7fe1, 0x1010].value, dtype=np.csingle)
-        data['freq_data'] = time2freq(data['time_data'],16)
-        data['freq_shift'] = (np.argmax(data['freq_data'])/data['freq_data'].shape[0]-0.5)*data['bandwidth']
-        data['freq_peak'] = np.max(data['freq_data'])
-        data['freq_sum'] = np.sum(data['freq_data'])
+# read the header up to the end of the siemens CSA group, without the
+# private data and spectroscopy payload after it. the CSA image header is
+# not always in the first private block, spectroscopy files can have
+# SIEMENS CSA NON-IMAGE there and the CSA headers in the second block, so
+# nibabel looks it up by its private creator
+def read_header(fp):
+    return pydicom.filereader.read_partial(fp, stop_when=lambda tag, VR, length: tag > CSA_GROUP_END)
+
+# memory map the spectroscopy payload of a siemens fid file, continuing from
+# where read_header stopped
+def read_fid_data(fp, dcm):
+    found = []
+    def at_fid_data(tag, VR, length):
+        if tag == FID_DATA:
+            found.append((fp.tell(), length))
+        return tag >= FID_DATA
+    # only the tags are parsed on the way, all values are skipped
+    pydicom.filereader.read_dataset(fp, dcm.is_implicit_VR, dcm.is_little_endian, stop_when=at_fid_data, specific_tags=[FID_DATA])
+    if found and found[0][1] != 0xFFFFFFFF and dcm.is_little_endian:
+        offset, length = found[0]
+        return np.memmap(fp.name, dtype=np.csingle, mode='r', offset=offset, shape=(length//8,))
+    # fall back to a full read
+    return np.frombuffer(pydicom.dcmread(fp.name)[0x7fe1, 0x1010].value, dtype=np.csingle)
+
+# read one dicom MRS file, returns None if not a fid
+def read_fid(data_in:str, filename:str):
+    try:
+        with open(os.path.join(data_in,filename), 'rb') as fp:
+            return parse_fid(fp, filename)
+    except OSError:
+        return None
+
+def parse_fid(fp, filename:str):
+    from nibabel.nicom import csareader
+    try:
+        dcm = read_header(fp)
+    except:
+        ##print(f"{filename} is not a dicom")
+        return None
+
+    # check if a fid sequence
+    try:
+        csa_image = csareader.get_csa_header(dcm,'image')['tags']
+        sequence = csa_image['SequenceName']['items'][0]
+        if sequence != "*fid":
+            return None
+    except:
+        #print(f"{filename} is not a valid Siemens FID file")
+        return None
+
+    data = {'filename': filename}
         
-        fids.append(data)
-        metadata = dcm
-        fids.sort(key=lambda x: x['voltage'])
+    #csa_series = csareader.get_csa_header(dcm,'series')['tags']
+    tr = csa_image['RepetitionTime']['items'][0]
+    data['voltage'] = csa_image['TransmitterReferenceAmplitude']['items'][0]
+    data['frequency'] = csa_image['ImagingFrequency']['items'][0] * 1e6
+    data['coil'] = csa_image['TransmittingCoil']['items'][0]
+    data['nucleus'] = csa_image['ImagedNucleus']['items'][0]
+    data['flipangle'] = csa_image['FlipAngle']['items'][0]
+    data['bandwidth'] = csa_image['PixelBandwidth']['items'][0]
+    data['description'] = dcm['SeriesDescription'].value
+    data['description2'] = dcm['StudyDescription'].value
+    #if int(data['voltage']) == 75:
+    #    with open('csa_image.txt', 'w') as f:
+    #        f.write(json.dumps(csa_image,indent=3,default=lambda o: '<not serializable>'))
+   
+    # read data array, only for confirmed fids
+    try:
+        data['time_data'] = read_fid_data(fp, dcm)
+    except:
+        print(f"Could not read FID data from {filename}")
+        return None
+    return data, dcm
+
+# read dicom MRS files
+def read_files(data_in:str, workers:int=8):
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        found = [f for f in ex.map(lambda filename: read_fid(data_in, filename), os.listdir(data_in)) if f]
+    fids = [data for data, dcm in found]
+    metadata = found[-1][1] if found else None
+    fids.sort(key=lambda x: x['voltage'])
+
+    # calculate spectra and signal amplitudes for all fids at once
+    if fids:
+        for data, freq_data in zip(fids, time2freq_stack([f['time_data'] for f in fids],16)):
+            data['freq_data'] = freq_data
+            data['freq_shift'] = (np.argmax(data['freq_data'])/data['freq_data'].shape[0]-0.5)*data['bandwidth']
+            data['freq_peak'] = np.max(data['freq_data'])
+            data['freq_sum'] = np.sum(data['freq_data'])
     return fids, metadata
 
 # main part
@@ -173,46 +286,87 @@ def analyze_fids(fids, ax, noise = False):
 
     return vref
 
+uid_prefix = '1.3.12.2.1107.5.2.38.151026.'
+figure = None # (fig, ax), reused for all plots
+template = None # dataset with the fields that are the same for all images
+
+# headless figure, matplotlib is only imported on first use
+def get_figure():
+    global figure
+    if figure is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.style
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        matplotlib.style.use('dark_background')
+        fig = Figure(figsize=(8,8))
+        FigureCanvasAgg(fig)
+        figure = (fig, fig.add_subplot(1,1,1))
+    fig, ax = figure
+    ax.clear()
+    return fig, ax
+
+def get_template(rows, columns):
+    global template
+    if template is None or (template.Rows, template.Columns) != (rows, columns):
+        ds = pydicom.dataset.Dataset()
+        file_meta = pydicom.dataset.FileMetaDataset()
+        #file_meta.FileMetaInformationGroupLength = 222
+        #file_meta.FileMetaInformationVersion = b'\x00\x01'
+        file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+        file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+        #file_meta.SourceApplicationEntityTitle = #''
+        ds.file_meta = file_meta
+
+        # stuff
+        ds.SpecificCharacterSet = 'ISO_IR 100'
+        ds.Modality = 'MR'
+        ds.InstanceNumber = 1
+        ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+        ds.AcquisitionNumber = 1
+        ds.SeriesNumber = 1337
+
+        # image data related
+        ds.ProtocolName = 'Coil Vref Calibration'
+        ds.ImageType = ['ORIGINAL', 'PRIMARY']
+        #ds.ImageType = ['Derived', 'Secondary']
+        ds.Rows, ds.Columns = rows, columns
+        ds.is_little_endian = True
+        ds.BitsStored = 8
+        ds.SamplesPerPixel = 3
+        ds.BitsAllocated = 8
+        ds.HighBit = ds.BitsStored - 1
+        ds.PhotometricInterpretation = 'RGB'
+        ds.PlanarConfiguration = 0
+        ds.PixelRepresentation = 0
+        template = ds
+    return copy.deepcopy(template)
+
 # save to dicom
 def fig2dicom(fig, description, metadata, data_out=None):
-    # draw fig
+    # draw fig, and use the RGB part of the canvas buffer as pixel data
+    t0 = time.perf_counter()
     fig.canvas.draw()
+    rgba = np.asarray(fig.canvas.buffer_rgba())
 
     # save to dicom
     ts = datetime.now()
-    ds = pydicom.dataset.Dataset()
-    uid_prefix = '1.3.12.2.1107.5.2.38.151026.'
-
-    file_meta = pydicom.dataset.FileMetaDataset()
-    #file_meta.FileMetaInformationGroupLength = 222
-    #file_meta.FileMetaInformationVersion = b'\x00\x01'
-    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
-    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid(prefix=uid_prefix)
-    file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
-    #file_meta.SourceApplicationEntityTitle = #''
-
-    ds.file_meta = file_meta
-
-    # stuff
-    ds.SpecificCharacterSet = 'ISO_IR 100'
-    ds.ImageType = ['DERIVED', 'PRIMARY']
-    ds.Modality = 'MR'
+    ds = get_template(*rgba.shape[:2])
     ds.StationName = metadata.StationName
     ds.AccessionNumber = metadata.AccessionNumber
 
     ds.InstanceCreationDate = ts.strftime('%Y%m%d')
     ds.InstanceCreationTime = ts.strftime('%H%M%S.000000')
-    ds.InstanceNumber = 1
 
     ds.ContentDate = ds.InstanceCreationDate
     ds.ContentTime = ds.InstanceCreationTime
 
-    ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
     ds.SOPInstanceUID = pydicom.uid.generate_uid(prefix=uid_prefix)
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
 
     ds.AcquisitionDate = metadata.AcquisitionDate
     ds.AcquisitionTime = metadata.AcquisitionTime
-    ds.AcquisitionNumber = 1
 
     ds.StudyDate = metadata.StudyDate
     ds.StudyTime = metadata.StudyTime
@@ -222,7 +376,6 @@ def fig2dicom(fig, description, metadata, data_out=None):
 
     ds.SeriesDate = metadata.SeriesDate
     ds.SeriesTime = metadata.SeriesTime
-    ds.SeriesNumber = 1337
     ds.SeriesDescription = description
     ds.SeriesInstanceUID = pydicom.uid.generate_uid(prefix=uid_prefix)
 
@@ -231,21 +384,10 @@ def fig2dicom(fig, description, metadata, data_out=None):
     ds.PatientBirthDate = metadata.PatientBirthDate
     ds.PatientPosition = metadata.PatientPosition
 
-    # image data related
-    ds.ProtocolName = 'Coil Vref Calibration'
-    ds.ImageType = ['ORIGINAL', 'PRIMARY']
-    ds.Rows, ds.Columns = fig.canvas.get_width_height()
-    ds.is_little_endian = True
-    ds.BitsStored = 8
-    ds.SamplesPerPixel = 3
-    ds.BitsAllocated = 8
-    ds.HighBit = ds.BitsStored - 1
-    ds.PhotometricInterpretation = 'RGB'
-    ds.PixelRepresentation = 0
-    ds.PixelData = fig.canvas.tostring_rgb()
-    #ds.ImageType = ['Derived', 'Secondary']
+    ds.PixelData = rgba[:,:,:3].tobytes()
 
     ds.fix_meta_info()
+    print(f"Rendered '{description}' in {(time.perf_counter()-t0)*1000:.0f} ms")
     if data_out:
         if not os.path.exists(os.path.dirname(data_out)):
             os.makedirs(os.path.dirname(data_out))
@@ -255,12 +397,20 @@ def fig2dicom(fig, description, metadata, data_out=None):
             ds.save_as(data_out, write_like_original=False)
     return ds
 
+# import the slow modules and set up the figure ahead of the first job, so
+# forked jobs start with them loaded
+def warmup():
+    t0 = time.perf_counter()
+    for module in ('nibabel.nicom.csareader', 'scipy.optimize', 'scipy.stats'):
+        importlib.import_module(module)
+    get_figure()
+    print(f"Warm-up done in {time.perf_counter()-t0:.2f} s")
+
 def process_fids(data_in, data_out=None):
     # read fids
     fids, metadata = read_files(data_in)
     # ready plots
-    plt.style.use('dark_background')
-    fig, ax = plt.subplots(1,1,figsize=(8,8))
+    fig, ax = get_figure()
 
     # analyze and create plot
     vref = analyze_fids(fids, ax, True)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+import importlib
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'app'))
+import xnuccalc
+
+def synthetic_sets(n, seed=0):
+    # calibration like curves, signal over the noise floor at 15 voltages
+    rng = np.random.default_rng(seed)
+    voltages = np.arange(25, 400, 25, dtype=float)
+    sets = []
+    for _ in range(n):
+        vref = rng.uniform(120, 300)
+        amplitudes = 1.5e5*np.abs(np.sin(np.pi/2*voltages/vref)) + 3000
+        amplitudes += rng.normal(scale=0.02*amplitudes.max(), size=voltages.shape)
+        sets.append({'voltages': voltages.tolist(), 'amplitudes': np.abs(amplitudes).tolist()})
+    return sets
+
+def run(backend, sets, noise):
+    results, times = [], []
+    for s in sets:
+        t0 = time.perf_counter()
+        results.append(xnuccalc.find_vref(np.array(s['voltages']), np.array(s['amplitudes']), noise, backend))
+        times.append(time.perf_counter() - t0)
+    return results, times
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the scipy and lmfit Vref fits')
+    parser.add_argument('--data', metavar='FILE', help='json list of recorded {"voltages": [...], "amplitudes": [...]} sets')
+    parser.add_argument('--sets', type=int, default=50, help='number of synthetic sets if no data is given')
+    parser.add_argument('--no-noise', action='store_true', help='fit without the noise floor')
+    args = parser.parse_args()
+
+    if args.data:
+        with open(args.data) as fp:
+            sets = json.load(fp)
+    else:
+        sets = synthetic_sets(args.sets)
+    noise = not args.no_noise
+    warnings.simplefilter('ignore')
+
+    t0 = time.perf_counter()
+    importlib.import_module('lmfit')
+    print(f"lmfit import {(time.perf_counter()-t0)*1000:8.1f} ms")
+
+    ref, ref_times = run('lmfit', sets, noise)
+    fast, fast_times = run('scipy', sets, noise)
+    for name, times in (('lmfit', ref_times), ('scipy', fast_times)):
+        print(f"{name:6} median {np.median(times)*1000:7.2f} ms  max {np.max(times)*1000:7.2f} ms")
+
+    dvref = [abs(a[0]-b[0]) for a, b in zip(ref, fast)]
+    dfit = [np.max(np.abs(a[3]-b[3]))/np.max(np.abs(a[3])) for a, b in zip(ref, fast)]
+    dband = [np.max(np.abs(a[4]-b[4]))/np.max(a[4]) for a, b in zip(ref, fast) if np.max(a[4]) > 0]
+    # the fits can end in different minima on bad data, so count those
+    # separately from the typical difference
+    print(f"Vref difference   median {np.median(dvref):.3g} V, {sum(d > 1 for d in dvref)}/{len(sets)} sets differ by more than 1 V")
+    print(f"fit difference    median {np.median(dfit):.3g} (relative)")
+    if dband:
+        print(f"band difference   median {np.median(dband):.3g} (relative)")
+    for i, (a, b) in enumerate(zip(ref, fast)):
+        if abs(a[0]-b[0]) > 1:
+            print(f"\tset {i}: lmfit {a[0]:.1f} V, scipy {b[0]:.1f} V")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import os
+import json
+import struct
+import argparse
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+CSA_NON_IMAGE_STORAGE = '1.3.12.2.1107.5.9.1'
+
+# encode a siemens CSA2 header from (name, vr, values)
+def csa2(tags):
+    out = [b'SV10', b'\4\3\2\1', struct.pack('<2I', len(tags), 77)]
+    for name, vr, values in tags:
+        out.append(struct.pack('<64si4s3i', name.encode(), len(values), vr.encode(), 0, len(values), 77))
+        for value in values:
+            item = str(value).encode() + b'\0'
+            out.append(struct.pack('<4i', len(item), len(item), 77, len(item)))
+            out.append(item + b'\0'*(-len(item) % 4))
+    return b''.join(out)
+
+# damped, phase shifted FID with noise, the peak follows a sine of the voltage
+def make_signal(voltage, vref, points, rng):
+    t = np.arange(points)/points
+    amplitude = 8000*abs(np.sin(np.pi/2*voltage/vref))
+    fid = amplitude*np.exp(1j*(0.7+30*t))*np.exp(-4*t)
+    fid += 50*(rng.normal(size=points) + 1j*rng.normal(size=points))
+    return fid.astype(np.csingle)
+
+def make_fid(study_uid, voltage, instance, vref, points, rng, layout='image'):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CSA_NON_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SpecificCharacterSet = 'ISO_IR 100'
+    ds.SOPClassUID = CSA_NON_IMAGE_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyDate = ds.SeriesDate = ds.AcquisitionDate = '20220101'
+    ds.StudyTime = ds.SeriesTime = ds.AcquisitionTime = '120000'
+    ds.AccessionNumber = ''
+    ds.Modality = 'MR'
+    ds.Manufacturer = 'SIEMENS'
+    ds.StationName = 'MRC51014'
+    ds.StudyDescription = 'Synthetic^Study'
+    ds.SeriesDescription = f"fid_{voltage}V"
+    ds.PatientName = 'Synthetic^Patient'
+    ds.PatientID = '0000000000'
+    ds.PatientBirthDate = '19700101'
+    ds.PatientPosition = 'HFS'
+    ds.ProtocolName = f"fid_{voltage}V"
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = generate_uid()
+    ds.StudyID = '1'
+    ds.SeriesNumber = instance
+    ds.InstanceNumber = instance
+
+    # CSA image header with the fields read by xnuccalc, and a CSA series
+    # header of about the size of a real protocol dump. with the non-image
+    # layout of siemens spectroscopy files, the first private block is
+    # SIEMENS CSA NON-IMAGE and the CSA headers are in the second block
+    block = 0x10
+    if layout == 'non-image':
+        ds.add_new((0x0029, 0x0010), 'LO', 'SIEMENS CSA NON-IMAGE')
+        ds.add_new((0x0029, 0x0011), 'LO', 'SIEMENS CSA HEADER')
+        ds.add_new((0x0029, 0x1008), 'CS', 'SPEC NUM 4')
+        ds.add_new((0x0029, 0x1009), 'LO', '20220101')
+        block = 0x11
+    else:
+        ds.add_new((0x0029, 0x0010), 'LO', 'SIEMENS CSA HEADER')
+    ds.add_new((0x0029, block << 8 | 0x10), 'OB', csa2([
+        ('SequenceName', 'SH', ['*fid']),
+        ('RepetitionTime', 'DS', [1000]),
+        ('TransmitterReferenceAmplitude', 'DS', [voltage]),
+        ('ImagingFrequency', 'DS', [33.786]),
+        ('TransmittingCoil', 'SH', ['Na_Head']),
+        ('ImagedNucleus', 'SH', ['23Na']),
+        ('FlipAngle', 'DS', [90]),
+        ('PixelBandwidth', 'DS', [5000]),
+    ]))
+    ds.add_new((0x0029, block << 8 | 0x20), 'OB', bytes(200000))
+    ds.add_new((0x7fe1, 0x0010), 'LO', 'SIEMENS CSA NON-IMAGE')
+    ds.add_new((0x7fe1, 0x1010), 'OB', make_signal(voltage, vref, points, rng).tobytes())
+    return ds
+
+def make_fids(path, voltages=range(25, 400, 25), vref=200, points=1024, studyinfo=None, seed=0, layout='image'):
+    # write a coil calibration study in the layout storescp leaves in the
+    # scratch folder
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    study_uid = generate_uid()
+    files = []
+    for instance, voltage in enumerate(voltages, 1):
+        ds = make_fid(study_uid, voltage, instance, vref, points, rng, layout)
+        filename = os.path.join(path, f"MR.{ds.SOPInstanceUID}")
+        ds.save_as(filename, write_like_original=False)
+        files.append(filename)
+    if studyinfo is not None:
+        with open(os.path.join(path, 'studyinfo.json'), 'w') as fp:
+            json.dump(studyinfo, fp, indent=3)
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic coil calibration FID study')
+    parser.add_argument('path')
+    parser.add_argument('--vref', type=float, default=200)
+    parser.add_argument('--points', type=int, default=1024)
+    parser.add_argument('--layout', choices=['image', 'non-image'], default='image', help='private block holding the CSA headers, see make_fid')
+    args = parser.parse_args()
+    files = make_fids(args.path, vref=args.vref, points=args.points, layout=args.layout, studyinfo={'Local_AET': 'NMPROC', 'Remote_AET': 'SYNTH', 'Remote_Host': '127.0.0.1'})
+    print(f"Wrote {len(files)} files to {args.path}")